@@ -9,30 +9,35 @@ Usage:
     server.serve_forever()
 """
 
-import array
-import fcntl
-try:
-    import queue
-except ImportError:
-    import Queue as queue
-import select
+import queue
+import selectors
+import socket
 import struct
-try:
-    import socketserver
-except ImportError:
-    # Python 2 compatibility.
-    import SocketServer as socketserver
-import termios
+import socketserver
 import threading
 import time
 import traceback
 
-from .constants import VNCConstants
-from .surfacedata import SurfaceData
-from .pixeldata import PixelFormat
+from .constants import (VNCConstants, capability_bits,
+                        capability_DesktopSize, capability_DesktopName, capability_Apple1011)
+from .surfacedata import SurfaceData, changed_columns
+from .pixeldata import PixelFormat, converter_null
 from .clientmsg import dispatch_msg
+from .encoders import encoding_factories
 from .regions import Regions, RegionRequest
 from .security import get_security_types
+from .locks import ReadWriteLock
+
+
+# Socket option which holds back partial packets (Linux uses TCP_CORK, BSD uses TCP_NOPUSH)
+tcp_cork = getattr(socket, 'TCP_CORK', None) or getattr(socket, 'TCP_NOPUSH', None)
+
+
+# Server message structures, compiled once rather than on every message
+u32_struct = struct.Struct('>L')
+framebuffersize_struct = struct.Struct('>HH')
+framebufferupdate_struct = struct.Struct('>BBH')
+rectangle_struct = struct.Struct('>HHHHl')
 
 
 class CairoVNCOptions(object):
@@ -111,13 +116,28 @@ class CommStream(object):
     Replace this for encrypted traffic.
     """
     default_timeout = 2
+    recv_buffer_size = 65536
+    # Most buffers that may be passed to a single sendmsg call (POSIX requires at least 16)
+    iov_max = 1024
 
     def __init__(self, sock):
         self.sock = sock
         self.closed = False
-        self.data = []
-        self.datalen = 0
-        self.fionread_data = array.array('i', [0])
+        # Data which has been received but not yet consumed
+        self.data = bytearray()
+        # Buffer which is received into, so that each read doesn't allocate a new bytes object
+        self.recv_buffer = memoryview(bytearray(self.recv_buffer_size))
+
+        # The socket is registered once, rather than on every wait for data
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def close(self):
+        """
+        Mark the stream as closed and release the resources used to wait for data.
+        """
+        self.closed = True
+        self.selector.close()
 
     def log(self, message):
         #print("Comm: {}".format(message))
@@ -126,11 +146,38 @@ class CommStream(object):
     def readdata(self, nbytes):
         """
         Read data from the socket - may be overridden to decrypt the data from the wire
+
+        @param nbytes:  Maximum number of bytes to read
+
+        @return: bytes-like object, which is only valid until the next call
         """
         if self.closed:
             # If the connection was closed; we didn't get any data
             return b''
-        return self.sock.recv(nbytes)
+        if nbytes > len(self.recv_buffer):
+            self.recv_buffer = memoryview(bytearray(nbytes))
+        try:
+            received = self.sock.recv_into(self.recv_buffer, nbytes)
+        except OSError:
+            # Any error means the connection is closed
+            received = 0
+        return self.recv_buffer[:received]
+
+    def receive(self):
+        """
+        Read whatever data is available from the socket into our buffer.
+
+        The socket must already be known to be readable. We don't ask how much data is
+        waiting; a read of the whole receive buffer will return whatever is there.
+
+        @return: True if data was read, False if the connection was closed
+        """
+        data = self.readdata(len(self.recv_buffer))
+        if not data:
+            self.closed = True
+            return False
+        self.data += data
+        return True
 
     def writedata(self, data):
         """
@@ -138,124 +185,133 @@ class CommStream(object):
         """
         if self.closed:
             return
-        #self.log("Sending %r" % (data,))
         try:
-            self.sock.send(data)
+            self.sock.sendall(data)
         except Exception:
             # Any failure here is almost certainly fatal; mark the connection as closed
             self.closed = True
 
-    def fionread(self):
+    def writev(self, bufs):
+        """
+        Write a sequence of buffers to the socket, without joining them together first.
+
+        If the data must be transformed on the wire, an overriding class need only replace
+        writedata; this will fall back to it.
+
+        @param bufs:    list of bytes-like objects to send, in order
+        """
         if self.closed:
-            # If we were closed, then report that we have no data
-            return -1
-        if fcntl.ioctl(self.sock, termios.FIONREAD, self.fionread_data) == -1:
-            # Any error means the connection is closed
+            return
+        if type(self).writedata is not CommStream.writedata or not hasattr(self.sock, 'sendmsg'):
+            self.writedata(b''.join(bufs))
+            return
+
+        bufs = [memoryview(buf).cast('B') for buf in bufs if len(buf)]
+        # If it takes more than one call to send everything, hold back any partial packets
+        # until the end, rather than letting each call push out its own.
+        cork = len(bufs) > self.iov_max and tcp_cork
+        if cork:
+            self.set_cork(True)
+        try:
+            while bufs:
+                sent = self.sock.sendmsg(bufs[:self.iov_max])
+                # Discard everything which was sent, and send the remainder of any partial buffer
+                index = 0
+                while index < len(bufs) and sent >= len(bufs[index]):
+                    sent -= len(bufs[index])
+                    index += 1
+                del bufs[:index]
+                if sent:
+                    bufs[0] = bufs[0][sent:]
+        except Exception:
+            # Any failure here is almost certainly fatal; mark the connection as closed
             self.closed = True
-            return -1
-        return struct.unpack('I', self.fionread_data)[0]
+        if cork:
+            self.set_cork(False)
+
+    def set_cork(self, corked):
+        """
+        Hold back partial packets until uncorked, if the socket supports it.
+        """
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, tcp_cork, int(corked))
+        except OSError:
+            # Not a TCP socket, or already closed; the data is sent as it would be anyway
+            pass
+
+    def pending(self):
+        """
+        Check whether there is data waiting to be read, without blocking.
+
+        @return: True if data is buffered or waiting on the socket
+        """
+        if self.data:
+            return True
+        if self.closed:
+            return False
+        return bool(self.selector.select(0))
 
     def read_upto(self, terminator, timeout=None):
         """
         Read data until we hit a terminator, or timeout.
 
-        @param terminator:  Terminating string
+        @param terminator:  Terminating bytes
         @param timeout:     Timeout in seconds
 
-        @return: string before terminator, or None if timed out
+        @return: bytes before terminator, or None if timed out
         """
         if not timeout:
             timeout = self.default_timeout
         endtime = time.time() + timeout
-        if self.data:
-            # The data might already be present
-            current_data = b''.join(self.data)
-            index = current_data.find(terminator)
-            if index != -1:
-                self.data = [current_data[index + len(terminator):]]
-                self.datalen = len(self.data[0])
-                return current_data[:index]
-            self.data = []
-            self.datalen = 0
-        else:
-            current_data = b''
 
-        while not self.closed:
+        # The data might already be present
+        index = self.data.find(terminator)
+        while index == -1 and not self.closed:
             timeout = endtime - time.time()
             if timeout <= 0:
                 break
-            (rlist, wlist, xlist) = select.select([self.sock], [], [], timeout)
-            if rlist:
-                nbytes = self.fionread()
-                if nbytes <= 0:
-                    self.closed = True
+            if self.selector.select(timeout):
+                # Only the new data (and enough of the old data to hold a terminator
+                # which straddles the two) needs to be searched.
+                start = max(0, len(self.data) - len(terminator) + 1)
+                if not self.receive():
                     break
-                current_data += self.readdata(nbytes)
-                index = current_data.find(terminator)
-                if index != -1:
-                    self.data = [current_data[index + len(terminator):]]
-                    self.datalen = len(self.data[0])
-                    return current_data[:index]
+                index = self.data.find(terminator, start)
 
-        self.data = [current_data]
-        self.datalen = len(current_data)
-        return None
+        if index == -1:
+            return None
+
+        data = bytes(self.data[:index])
+        del self.data[:index + len(terminator)]
+        return data
 
     def read_nbytes(self, size, timeout=None):
         """
         Read a fixed number of bytes, or timeout.
 
         @param size:    number of bytes to read
-        @param timeout:     Timeout in seconds
+        @param timeout:     Timeout in seconds (0 to only read data which is already available)
 
         @return: bytes read, or None if timed out
         """
-        if not timeout:
+        if timeout is None:
             timeout = self.default_timeout
         endtime = time.time() + timeout
-        data = []
-        while not self.closed:
-            timeout = endtime - time.time()
-            if timeout <= 0:
-                break
-
-            while self.datalen >= size and size != 0:
-                first = self.data[0]
-                if len(first) <= size:
-                    data.append(first)
-                    self.data.pop(0)
-                    self.datalen -= len(first)
-                    size -= len(first)
-                else:
-                    data.append(first[:size])
-                    self.data[0] = first[size:]
-                    self.datalen -= size
-                    size = 0
-            if size == 0:
-                break
-
+        while len(self.data) < size and not self.closed:
             # Put more data into the buffer
-            self.log("Awaiting %i bytes (got %r, buffered %r, datalen %r)" % (size, data, self.data, self.datalen))
-            (rlist, wlist, xlist) = select.select([self.sock], [], [], timeout)
-            if rlist:
-                nbytes = self.fionread()
-                if nbytes <= 0:
+            if self.selector.select(max(0, endtime - time.time())):
+                if not self.receive():
                     # Connection was closed
-                    self.closed = True
                     break
-                self.log("Reading %i bytes" % (nbytes,))
-                got = self.readdata(nbytes)
-                self.data.append(got)
-                self.datalen += len(got)
-
-        data = b''.join(data)
-        if size:
-            # We timed out before all the data was read. Put what we have back at the start
-            # of the buffer.
-            if data:
-                self.data.insert(0, data)
+            elif time.time() >= endtime:
+                break
+
+        if len(self.data) < size:
+            # We timed out before all the data was read; it remains in the buffer.
             return None
 
+        data = bytes(self.data[:size])
+        del self.data[:size]
         return data
 
 
@@ -277,6 +333,13 @@ class VNCConnection(socketserver.BaseRequestHandler):
     # Timeout for receiving any payload data once we know that we're receiving data from client
     payload_timeout = 5
 
+    # Most messages handled in one go before we look at sending a framebuffer update, so
+    # that a client sending a stream of events cannot hold off its own updates
+    max_messages_per_update = 64
+
+    # Size of the socket's send buffer, so that a whole framebuffer update can be queued
+    send_buffer_size = 1 << 20
+
     def setup(self):
         """
         Set up variables for a remote connection which is about to start.
@@ -284,19 +347,11 @@ class VNCConnection(socketserver.BaseRequestHandler):
         Thread: Connection thread
         """
         self.connected = False
+        self.configure_socket(self.request)
         self.stream = CommStream(self.request)
 
+        # The PixelFormat defaults are our internal format
         self.pixelformat = PixelFormat()
-        self.pixelformat.bpp = 32
-        self.pixelformat.depth = 24
-        self.pixelformat.endianness = VNCConstants.PixelFormat_LittleEndian
-        self.pixelformat.truecolour = VNCConstants.PixelFormat_TrueColour
-        self.pixelformat.redmax = 255
-        self.pixelformat.greenmax = 255
-        self.pixelformat.bluemax = 255
-        self.pixelformat.redshift = 16
-        self.pixelformat.greenshift = 8
-        self.pixelformat.blueshift = 0
 
         # Current framebuffer size
         self.width = None
@@ -319,11 +374,23 @@ class VNCConnection(socketserver.BaseRequestHandler):
         self.changed_name = False
 
         # The capabilities for communicating with the client
-        self.capabilities = set([])
+        self.capabilities = frozenset()
+        # The capabilities listed in capability_bits, as a bit mask
+        self.capability_mask = 0
+        # The encoding used for the framebuffer updates
+        self.encoding = VNCConstants.Encoding_Raw
+        # The encoder for that encoding, or None for Raw
+        self.encoder = None
+        # The encoders we have created for this client, keyed by the encoding; they are
+        # kept because some hold state which the client's decoder shares
+        self.encoders = {}
 
         # FrameUpdate variables
         self.request_regions = Regions()
         self.last_rows = {}
+        # The frame version, and range of rows, for which last_rows matches the surface
+        self.synced_version = None
+        self.synced_rows = (0, 0)
         self.min_frame_period = 1.0 / self.options.max_framerate
         self.last_frameupdate_time = 0          # When we last sent a frame update
         self.last_frameupdaterequest_time = 0   # When they last requested a frame update
@@ -346,6 +413,24 @@ class VNCConnection(socketserver.BaseRequestHandler):
         except Exception as exc:
             self.log_exception(exc)
 
+    def configure_socket(self, sock):
+        """
+        Set the options on the client's socket.
+
+        The handshake is made up of small messages which must not be held back waiting
+        for more data, so Nagle's algorithm is disabled. Keepalives let us notice clients
+        which have gone away without closing the connection.
+
+        Thread: Connection thread
+        """
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        except OSError as exc:
+            # Not fatal; the connection will just be less responsive
+            self.log("Could not configure socket: %s", exc)
+
     def finish(self):
         """
         Clean up after the connection has been handled.
@@ -355,7 +440,7 @@ class VNCConnection(socketserver.BaseRequestHandler):
         if self.connected:
             # We only notify the server object that we disconnected if we had said we were connected
             self.server.client_disconnected(self)
-        self.stream.closed = True
+        self.stream.close()
 
     def disconnect(self):
         """
@@ -382,13 +467,28 @@ class VNCConnection(socketserver.BaseRequestHandler):
         """
         return self.stream.writedata(data)
 
-    def log(self, message):
+    def writev(self, bufs):
+        """
+        Write a list of buffers to the connection, blocking until all the data is sent.
+
+        Thread: Connection thread
+        """
+        return self.stream.writev(bufs)
+
+    def log(self, message, *args):
         """
         Log a message to the server object.
 
         Thread: Connection thread
+
+        @param message: Message string, or a format string if args are given
+        @param args:    Arguments to format into the message; the formatting is only
+                        performed if the server is logging
         """
-        self.server.client_log(self, message)
+        if self.server.log_enabled:
+            if args:
+                message = message % args
+            self.server.client_log(self, message)
 
     def log_exception(self, exc):
         """
@@ -450,7 +550,7 @@ class VNCConnection(socketserver.BaseRequestHandler):
             security_supported = sorted(security_types)  # Make the types given deterministic
             security_data = [len(security_supported)]
             security_data.extend(security_supported)
-            data = bytearray(security_data)
+            data = bytes(security_data)
             self.stream.writedata(data)
 
             response = self.read(1, timeout=self.connect_timeout)
@@ -458,13 +558,13 @@ class VNCConnection(socketserver.BaseRequestHandler):
                 # Timeout, or disconnect
                 self.log("Timed out at Security Handshake")
                 return False
-            self.sectype = bytearray(response)[0]
+            self.sectype = response[0]
         else:
             if VNCConstants.Security_VNCAuthentication in security_types:
                 self.sectype = VNCConstants.Security_VNCAuthentication
             else:
                 self.sectype = VNCConstants.Security_None
-            data = struct.pack('>I', self.sectype)
+            data = u32_struct.pack(self.sectype)
             self.stream.writedata(data)
 
         self.security = security_types.get(self.sectype, None)
@@ -474,18 +574,18 @@ class VNCConnection(socketserver.BaseRequestHandler):
 
         self.log("Security: {}".format(self.security.name))
         failed = self.security.authenticate()
-        self.log("Security result: %r" % (failed or 'Success',))
+        self.log("Security result: %r", failed or 'Success')
 
         # For 'No encryption' there isn't a SecurityResult prior to 3.8
         has_security_result = (self.protocol >= b'003.008' or self.sectype != VNCConstants.Security_None)
         if has_security_result:
             # 7.1.3. SecurityResult Handshake
             if failed:
-                data = struct.pack('>L', VNCConstants.SecurityResult_Failed)
+                data = u32_struct.pack(VNCConstants.SecurityResult_Failed)
                 if self.protocol >= b'003.008':
-                    data += struct.pack('>L', len(failed)) + failed.encode('iso-8859-1')
+                    data += u32_struct.pack(len(failed)) + failed.encode('iso-8859-1')
             else:
-                data = struct.pack('>L', VNCConstants.SecurityResult_OK)
+                data = u32_struct.pack(VNCConstants.SecurityResult_OK)
             self.stream.writedata(data)
 
         if failed:
@@ -511,7 +611,7 @@ class VNCConnection(socketserver.BaseRequestHandler):
             # FIXME: Report the failure
             return False
 
-        (shared_flag,) = struct.unpack('B', response)
+        shared_flag = response[0]
         # FIXME: Do we want to honour this or just ignore it?
         if shared_flag == VNCConstants.ClientInit_Exclusive:
             self.log("ClientInit: Requested exclusive access (denied, as not supported)")
@@ -533,12 +633,12 @@ class VNCConnection(socketserver.BaseRequestHandler):
         self.height = height
         name = self.server.options.display_name
 
-        data_size = struct.pack('>HH', width, height)
+        data_size = framebuffersize_struct.pack(width, height)
         data_pixelformat = self.pixelformat.encode()
         name_encoded = name.encode('utf-8')
-        data_name = struct.pack('>L', len(name_encoded)) + name_encoded
+        data_name = u32_struct.pack(len(name_encoded)) + name_encoded
         data = data_size + data_pixelformat + data_name
-        self.log("ServerInit message: %r" % (data,))
+        self.log("ServerInit message: %r", data)
         self.stream.writedata(data)
 
         return True
@@ -570,17 +670,27 @@ class VNCConnection(socketserver.BaseRequestHandler):
         # Now we read messages from the client
         while not self.stream.closed:
             timeout = self.client_timeout
-            if self.request_regions or self.options.push_requests:
-                timeout = time.time() - self.last_frameupdate_time
-                if timeout < 0:
-                    timeout = 0
+            if self.request_regions or (self.options.push_requests and self.changed_frame):
+                # Don't wait beyond the point at which we can next send a frame
+                timeout = self.min_frame_period - (time.time() - self.last_frameupdate_time)
+                timeout = min(max(timeout, 0), self.client_timeout)
             response = self.read(1, timeout=timeout)
-            if response:
-                msgtype = bytearray(response)[0]
+
+            # Process all the messages that are waiting before we deliver any frame
+            # updates, so that any requests they make can be satisfied together.
+            handled = True
+            messages = 0
+            while response:
+                msgtype = response[0]
                 handled = dispatch_msg(msgtype, self)
-                if not handled:
-                    # Something went wrong; so we're done with this connection
+                messages += 1
+                if not handled or messages >= self.max_messages_per_update or \
+                   not self.stream.pending():
                     break
+                response = self.read(1, timeout=self.payload_timeout)
+            if not handled:
+                # Something went wrong; so we're done with this connection
+                break
 
             if self.changed_frame:
                 if self.options.push_requests:
@@ -602,18 +712,18 @@ class VNCConnection(socketserver.BaseRequestHandler):
                 # 7.8.2. DesktopSize Pseudo-Encoding
                 (new_width, new_height) = self.server.surface_size()
                 if new_width != self.width or new_height != self.height:
-                    if VNCConstants.PseudoEncoding_DesktopSize in self.capabilities:
+                    if self.capability_mask & capability_DesktopSize:
                         # We can only send the new desktop size if it's in the capabilities.
-                        msg = struct.pack('>BBHHHHHl',
-                                          VNCConstants.ServerMsgType_FramebufferUpdate, 0,
-                                          1,  # one rectangle update
-                                          0, 0, new_width, new_height,
-                                          VNCConstants.PseudoEncoding_DesktopSize)
+                        msg = framebufferupdate_struct.pack(VNCConstants.ServerMsgType_FramebufferUpdate, 0,
+                                                            1)  # one rectangle update
+                        msg += rectangle_struct.pack(0, 0, new_width, new_height,
+                                                     VNCConstants.PseudoEncoding_DesktopSize)
                         self.log("Notify of DesktopSize {}x{}".format(new_width, new_height))
                         self.write(msg)
 
                         # Assume that we have to deliver the entire buffer
                         self.last_rows = {}
+                        self.synced_version = None
                     else:
                         self.log("Client cannot receive DesktopSize {}x{}".format(new_width, new_height))
 
@@ -638,15 +748,14 @@ class VNCConnection(socketserver.BaseRequestHandler):
             if self.changed_name:
                 if self.options.display_name != self.server.options.display_name:
                     name_encoded = self.server.options.display_name.encode('utf-8')
-                    if VNCConstants.PseudoEncoding_DesktopName in self.capabilities:
+                    if self.capability_mask & capability_DesktopName:
                         # We can only send the new desktop name if it's in the capabilities.
                         # Support for name changing is variable between clients.
-                        msg = struct.pack('>BBHHHHHl',
-                                          VNCConstants.ServerMsgType_FramebufferUpdate, 0,
-                                          1,  # one rectangle update
-                                          0, 0, 0, 0,  # x,y,width,height must be 0
-                                          VNCConstants.PseudoEncoding_DesktopName)
-                        data_name = struct.pack('>L', len(name_encoded)) + name_encoded
+                        msg = framebufferupdate_struct.pack(VNCConstants.ServerMsgType_FramebufferUpdate, 0,
+                                                            1)  # one rectangle update
+                        msg += rectangle_struct.pack(0, 0, 0, 0,  # x,y,width,height must be 0
+                                                     VNCConstants.PseudoEncoding_DesktopName)
+                        data_name = u32_struct.pack(len(name_encoded)) + name_encoded
                         msg += data_name
                         self.log("Notify of DesktopName {}".format(name_encoded))
                         self.write(msg)
@@ -664,24 +773,33 @@ class VNCConnection(socketserver.BaseRequestHandler):
             # otherwise protected, and can be quite involved)
             # Without this throttling, the server works as fast as it can, with the
             # client requesting data as fast as it can.
-            if time.time() - self.last_frameupdate_time >= self.min_frame_period:
+            if self.request_regions and \
+               time.time() - self.last_frameupdate_time >= self.min_frame_period:
                 # Don't update more often than the frame period
-                while self.request_regions:
-                    region = self.request_regions.pop()
+                for region in self.request_regions.coalesce():
                     self.update_framebuffer(region)
                 self.last_frameupdate_time = time.time()
 
     def update_framebuffer(self, region):
         """
-        Framebuffer updates here use only whole rows, because we're lazy here.
+        Framebuffer updates here are found from the rows which have changed, narrowed to
+        the columns which have changed within them when numpy is available.
 
         Thread: Connection thread
         """
-        (width, height, surface_rows) = self.server.surface_data()
-        if not region.incremental:
+        (width, height, surface_rows, version, pixels) = self.server.surface_frame()
+        region_rows = (region.y0, min(region.y1, len(surface_rows)))
+        if region.incremental and version == self.synced_version and \
+           self.synced_rows[0] <= region_rows[0] and region_rows[1] <= self.synced_rows[1]:
+            # We've already compared or sent these rows from this frame, so nothing has changed
+            redraw_range = []
+        elif not region.incremental:
             # Redraw the whole screen because it's not incremental
-            # The range list is a tuple of (row number start, the number of rows to draw)
-            redraw_range = [(region.y0, region.height)]
+            # The range list is a tuple of (column start, row start, number of columns,
+            # number of rows to draw)
+            # Only the rows which are present in the framebuffer can be sent.
+            rows = region_rows[1] - region_rows[0]
+            redraw_range = [(0, region_rows[0], width, rows)] if rows > 0 else []
         else:
             redraw_range = []
             diff_start = None
@@ -701,29 +819,68 @@ class VNCConnection(socketserver.BaseRequestHandler):
                         diff_size = 1
                 else:
                     if diff_start is not None:
-                        redraw_range.append((diff_start, diff_size))
+                        redraw_range.append((0, diff_start, width, diff_size))
                         diff_start = None
             if diff_start is not None:
-                redraw_range.append((diff_start, diff_size))
+                redraw_range.append((0, diff_start, width, diff_size))
+
+            if changed_columns:
+                # Only send the columns which have changed within each range of rows
+                for index, (_, y0, _, rows) in enumerate(redraw_range):
+                    old_rows = [self.last_rows.get(y, None) for y in range(y0, y0 + rows)]
+                    if None not in old_rows:
+                        (x0, x1) = changed_columns(surface_rows[y0:y0 + rows], old_rows, width)
+                        redraw_range[index] = (x0, y0, x1 - x0, rows)
 
         nrects = len(redraw_range)
-        msg_data = [struct.pack('>BBH', VNCConstants.ServerMsgType_FramebufferUpdate,
-                                        0,
-                                        nrects)]
+        msg_data = [framebufferupdate_struct.pack(VNCConstants.ServerMsgType_FramebufferUpdate,
+                                                  0,
+                                                  nrects)]
         if nrects:
-            self.log("FramebufferUpdate: {} rectangles to send".format(nrects))
-            for y0, rows in redraw_range:
-
-                rows_data = [struct.pack('>HHHHl', 0, y0, width, rows, VNCConstants.Encoding_Raw)]
-                self.log("    Sending rows {} - {}".format(y0, y0 + rows))
-                for y in range(y0, y0 + rows):
-                    rows_data.append(self.pixelformat.converter(surface_rows[y]))
-                    self.last_rows[y] = surface_rows[y]
+            self.log("FramebufferUpdate: %i rectangles to send", nrects)
+            converter = self.pixelformat.converter
+            encoding = self.encoding
+            encoder = self.encoder
+            for x0, y0, columns, rows in redraw_range:
+
+                msg_data.append(rectangle_struct.pack(x0, y0, columns, rows, encoding))
+                self.log("    Sending rows %i - %i, columns %i - %i", y0, y0 + rows, x0, x0 + columns)
+                rows_data = surface_rows[y0:y0 + rows]
+                if columns != width:
+                    # Only part of each row is sent
+                    block = b''.join([rowdata[x0 * 4:(x0 + columns) * 4] for rowdata in rows_data])
+                elif pixels is not None:
+                    # The rows are contiguous in the frame, so can be taken without copying
+                    block = pixels[y0 * width * 4:(y0 + rows) * width * 4]
+                    # A slice past the end of the frame would be short, and the rectangle
+                    # header would then not match the data sent.
+                    assert len(block) == rows * width * 4, \
+                        "Rows {}-{} lie outside the frame".format(y0, y0 + rows)
+                elif converter is converter_null and not encoder:
+                    block = None
+                else:
+                    block = b''.join(rows_data)
+
+                if encoder:
+                    msg_data.append(encoder(converter(block), columns, rows, self.pixelformat.bpp // 8))
+                elif converter is converter_null:
+                    # The rows are already in their format, so can be sent as they are
+                    if block is not None:
+                        msg_data.append(block)
+                    else:
+                        msg_data.extend(rows_data)
+                else:
+                    # Conversion works on whole words, so all the rows can be converted at once
+                    msg_data.append(converter(block))
+                for y, rowdata in enumerate(rows_data, y0):
+                    self.last_rows[y] = rowdata
 
-                msg_data.extend(rows_data)
+        # Every row in the region now matches what the client has
+        self.synced_version = version
+        self.synced_rows = region_rows
 
-        msg = b''.join(msg_data)
-        self.write(msg)
+        # The rows are gathered from their buffers as they are sent, rather than copied here
+        self.writev(msg_data)
 
     def set_capabilities(self, capabilities):
         """
@@ -731,10 +888,28 @@ class VNCConnection(socketserver.BaseRequestHandler):
 
         Thread: Connection thread
 
-        @param capabilities: A list of the encodings that the client is capable of
+        @param capabilities: A list of the encodings that the client is capable of; this
+                             replaces any that were previously given
         """
-        self.capabilities |= set(capabilities)
-        if VNCConstants.PseudoEncoding_Apple1011 in capabilities:
+        self.capabilities = frozenset(capabilities)
+        # The client lists its encodings in order of preference; Raw is always available
+        self.encoding = VNCConstants.Encoding_Raw
+        self.encoder = None
+        for encoding in capabilities:
+            if encoding == VNCConstants.Encoding_Raw:
+                break
+            if encoding in encoding_factories:
+                self.encoding = encoding
+                self.encoder = self.encoders.get(encoding)
+                if not self.encoder:
+                    self.encoder = encoding_factories[encoding]()
+                    self.encoders[encoding] = self.encoder
+                break
+        self.capability_mask = 0
+        for encoding, bit in capability_bits.items():
+            if encoding in self.capabilities:
+                self.capability_mask |= bit
+        if self.capability_mask & capability_Apple1011:
             # This is an Apple Screen Sharing client.
             # So we're going to enable the push frames, as otherwise it won't update.
             self.options.push_requests = True
@@ -791,6 +966,12 @@ class VNCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     A VNCServer provides the listening socket for a VNC server of a cairo buffer.
     """
     allow_reuse_address = True
+    # Many clients may connect at once (for example, when a viewer reconnects them all)
+    request_queue_size = 128
+    # The client threads are not tracked for joining when the server closes; the clients
+    # are told to disconnect instead, and the threads can then exit on their own.
+    daemon_threads = True
+    block_on_close = False
 
     def __init__(self, *args, **kwargs):
         self.clients = []
@@ -803,9 +984,7 @@ class VNCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
         self.event_queue = queue.Queue(self.options.event_queue_length)
 
-        # Can't do this on Python 2:
-        #super(VNCServer, self).__init__(*args, **kwargs)
-        socketserver.TCPServer.__init__(self, *args, **kwargs)
+        super().__init__(*args, **kwargs)
 
     def server_close(self):
         """
@@ -813,10 +992,6 @@ class VNCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
         Thread: Any thread
         """
-        # Can't do this on Python 2:
-        #super(VNCServer, self).server_close()
-        socketserver.TCPServer.server_close(self)
-
         for client in self.clients:
             # Mark the clients as disconnected so that they close down
             client.disconnect()
@@ -829,6 +1004,10 @@ class VNCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         except queue.Empty:
             pass
 
+        # The ThreadingMixIn may wait for the client threads here, so the clients
+        # must have been told to disconnect first.
+        super().server_close()
+
     def client_connected(self, client):
         """
         Notification that a client has connected and is about to be processed.
@@ -863,6 +1042,18 @@ class VNCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         with self.client_lock:
             self.clients.remove(client)
 
+    @property
+    def log_enabled(self):
+        """
+        Whether client_log will report messages; if not, the clients won't build them.
+
+        A subclass which replaces client_log always receives the messages, as it may
+        report them somewhere other than the verbose output.
+
+        Thread: Any thread
+        """
+        return self.options.verbose or type(self).client_log is not VNCServer.client_log
+
     def client_log(self, client, message):
         """
         Log messages from a client.
@@ -893,6 +1084,22 @@ class VNCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
                                                  max_framerate=self.options.max_framerate)
             return self._surface_data.get_data()
 
+    def surface_frame(self):
+        """
+        Read the current surface data, with its frame version.
+
+        Thread: Connection thread
+
+        @return: Tuple of (width, height, data, version, pixels). Data is as for surface_data();
+                 the version changes whenever the content of the surface changes; pixels is
+                 a memoryview of all the rows, or None if the rows are not contiguous.
+        """
+        with self.surface_data_lock:
+            if not self._surface_data:
+                self._surface_data = SurfaceData(self.surface, self.surface_lock,
+                                                 max_framerate=self.options.max_framerate)
+            return self._surface_data.get_frame()
+
     def surface_size(self):
         """
         Read the current surface width and height.
@@ -974,7 +1181,7 @@ class CairoVNCServer(object):
             options = CairoVNCOptions(host=host, port=port)
         self.options = options
         self.surface = surface
-        self.surface_lock = None
+        self.surface_lock = surface_lock
 
         # The object currently available for serving
         self.server = None
@@ -992,7 +1199,8 @@ class CairoVNCServer(object):
         if not self.server:
             self.server = self.server_class((self.options.host, self.options.port),
                                              self.connection_class,
-                                             surface=self.surface, options=self.options)
+                                             surface=self.surface, surface_lock=self.surface_lock or NullLock(),
+                                             options=self.options)
 
     def stop(self):
         """
@@ -0,0 +1,43 @@
+# cython: language_level=3
+"""
+Compiled splitting of the surface data into rows.
+
+This module is optional; build it in place with:
+
+    cythonize -i cairovnc/_surfacedata.pyx
+
+If it has not been built, the implementations in surfacedata.py are used.
+"""
+
+from libc.string cimport memcmp
+from cpython.bytes cimport PyBytes_FromStringAndSize
+
+
+def split_rows(const unsigned char[::1] data, Py_ssize_t height, Py_ssize_t stride):
+    """
+    Split the surface data into rows, sharing the objects for rows which repeat.
+
+    @param data:    Copy of the surface data
+    @param height:  Number of rows
+    @param stride:  Number of bytes between the rows
+
+    @return: list of rows of bytes()
+    """
+    cdef list rows = [None] * height
+    cdef const unsigned char *base
+    cdef const unsigned char *row_start
+    cdef Py_ssize_t y
+    cdef object row = None
+
+    if height == 0:
+        return rows
+    if data.shape[0] < height * stride:
+        raise ValueError("Surface data is too short for {} rows of {} bytes".format(height, stride))
+
+    base = &data[0]
+    for y in range(height):
+        row_start = base + y * stride
+        if y == 0 or memcmp(row_start, row_start - stride, stride) != 0:
+            row = PyBytes_FromStringAndSize(<const char *>row_start, stride)
+        rows[y] = row
+    return rows
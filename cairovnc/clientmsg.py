@@ -2,20 +2,40 @@
 Handlers for the messages that the clients may send.
 """
 
+import array
 import struct
+import sys
 import time
 
-from .constants import VNCConstants
+from .constants import VNCConstants, encoding_names
 from .regions import RegionRequest
 from .events import VNCEventMove, VNCEventClick, VNCEventKey
 
 
-message_handlers = {}
+# The handlers indexed directly by the message type byte (None for unrecognised messages)
+message_handlers = [None] * 256
 
+# Precompiled formats for the message payloads
+setencodings_struct = struct.Struct('>BH')
+framebufferupdaterequest_struct = struct.Struct('>BHHHH')
+keyevent_struct = struct.Struct('>BHL')
+pointerevent_struct = struct.Struct('>BHH')
 
-def register_msg(msgtype, payload_size):
+# Array type code for the signed 32 bit encoding numbers (usually 'i', but this is platform dependant)
+encoding_typecode = next(code for code in 'il' if array.array(code).itemsize == 4)
+
+
+def register_msg(msgtype, payload_size, tail_size=None):
+    """
+    Register a handler for a message type.
+
+    @param msgtype:         The message type number
+    @param payload_size:    The size of the fixed part of the payload
+    @param tail_size:       None if the payload is only the fixed part, or a function which
+                            is passed the fixed part and returns the size of the data that follows
+    """
     def register_func(func):
-        message_handlers[msgtype] = (func, payload_size)
+        message_handlers[msgtype] = (func, payload_size, tail_size)
         return func
     return register_func
 
@@ -26,44 +46,71 @@ def dispatch_msg(msgtype, connection):
 
     We read in the payload that the message uses, and then pass this to the handler function.
     """
-    if msgtype in message_handlers:
-        (func, payload_size) = message_handlers[msgtype]
-        name = func.__name__
-        response = connection.read(payload_size, timeout=connection.payload_timeout)
-        if not response:
-            connection.log("Timeout reading payload data for {}".format(name))
-            return False
-
-        func(connection, response)
-        return True
-    else:
-        connection.log("Unrecognised message type : %i" % (msgtype,))
+    entry = message_handlers[msgtype]
+    if entry is None:
+        connection.log("Unrecognised message type : %i", msgtype)
         return False
 
+    (func, payload_size, tail_size) = entry
+    payload_timeout = connection.payload_timeout
+    response = connection.read(payload_size, timeout=payload_timeout)
+    if not response:
+        connection.log("Timeout reading payload data for %s", func.__name__)
+        return False
+
+    if tail_size:
+        size = tail_size(response)
+        if size:
+            tail = connection.read(size, timeout=payload_timeout)
+            if not tail:
+                connection.log("Timeout reading trailing data for %s", func.__name__)
+                return False
+            response += tail
+
+    func(connection, response)
+    return True
+
+
+def encodings_description(encodings):
+    """
+    Describe a list of encodings by their names, for logging.
+    """
+    get_name = encoding_names.get
+    return ', '.join([get_name(enc, str(enc)) for enc in encodings])
+
+
+def setencodings_tail_size(payload):
+    (_, nencodings) = setencodings_struct.unpack(payload)
+    return 4 * nencodings
+
+
+def clientcuttext_tail_size(payload):
+    return int.from_bytes(payload[3:7], 'big')
+
 
 @register_msg(VNCConstants.ClientMsgType_SetPixelFormat, payload_size=3 + 16)
 def msg_SetPixelFormat(connection, payload):
     connection.pixelformat.decode(payload[3:])
-    connection.log("SetPixelFormat: %r" % (connection.pixelformat,))
+    connection.log("SetPixelFormat: %r", connection.pixelformat)
 
 
-@register_msg(VNCConstants.ClientMsgType_SetEncodings, payload_size=1 + 2)
+@register_msg(VNCConstants.ClientMsgType_SetEncodings, payload_size=1 + 2,
+              tail_size=setencodings_tail_size)
 def msg_SetEncodings(connection, payload):
-    (_, nencodings) = struct.unpack('>BH', payload)
-    response = connection.read(4 * nencodings, timeout=connection.payload_timeout)
-    if not response:
-        connection.log("Timeout reading SetEncodings data")
-        return
-    encodings = struct.unpack('>' + 'l' * nencodings, response)
-    connection.log("SetEncodings: %i encodings: (%r)" % (nencodings, encodings))
-    encoding_names = (VNCConstants.encoding_names.get(enc, str(enc)) for enc in encodings)
-    connection.log("SetEncodings: names: %s" % (', '.join(encoding_names)))
+    (_, nencodings) = setencodings_struct.unpack_from(payload)
+    encodings = array.array(encoding_typecode, payload[setencodings_struct.size:])
+    if sys.byteorder == 'little':
+        # The encodings were sent in network (big endian) order
+        encodings.byteswap()
+    if connection.server.log_enabled:
+        connection.log("SetEncodings: %i encodings: (%r)", nencodings, tuple(encodings))
+        connection.log("SetEncodings: names: %s", encodings_description(encodings))
     connection.set_capabilities(encodings)
 
 
 @register_msg(VNCConstants.ClientMsgType_FramebufferUpdateRequest, payload_size=1 + 2 * 4)
 def msg_FramebufferUpdateRequest(connection, payload):
-    (incremental, xpos, ypos, width, height) = struct.unpack('>BHHHH', payload)
+    (incremental, xpos, ypos, width, height) = framebufferupdaterequest_struct.unpack(payload)
     region = RegionRequest(incremental, xpos, ypos, width, height)
     #connection.log("FramebufferUpdateRequest: {!r}".format(region))
     connection.request_regions.add(region)
@@ -79,42 +126,43 @@ def msg_FramebufferUpdateRequest(connection, payload):
 
 @register_msg(VNCConstants.ClientMsgType_KeyEvent, payload_size=1 + 2 + 4)
 def msg_KeyEvent(connection, payload):
-    (down, _, key) = struct.unpack('>BHL', payload)
+    (down, _, key) = keyevent_struct.unpack(payload)
     if not connection.options.read_only:
-        connection.log("KeyEvent: key=%i, down=%i" % (key, down))
+        connection.log("KeyEvent: key=%i, down=%i", key, down)
         connection.queue_event(VNCEventKey(key, down))
 
 
 @register_msg(VNCConstants.ClientMsgType_PointerEvent, payload_size=1 + 2 * 2)
 def msg_PointerEvent(connection, payload):
-    (buttons, xpos, ypos) = struct.unpack('>BHH', payload)
-    if not connection.options.read_only:
-        connection.log("PointerEvent: buttons=%i, pos=%i,%i" % (buttons, xpos, ypos))
-
-        # We want to be able to discard movement events and report clicks separately
-        # First we deliver any movement events.
-        if xpos != connection.pointer_xpos or ypos != connection.pointer_ypos:
-            connection.queue_event(VNCEventMove(xpos, ypos, buttons))
-            connection.pointer_xpos = xpos
-            connection.pointer_ypos = ypos
-        diff = connection.pointer_buttons ^ buttons
-        connection.pointer_buttons = buttons
-        if diff:
-            # Buttons changed, so we need to deliver click or release events
-            for button in range(0, 8):
-                bit = (1<<button)
-                if diff & bit:
-                    connection.queue_event(VNCEventClick(xpos, ypos, button, buttons & bit))
-
-
-@register_msg(VNCConstants.ClientMsgType_ClientCutText, payload_size=3 + 4)
-def msg_ClientCutText(connection, payload):
-    (_, textlen) = struct.unpack('>3sL', payload)
-    response = connection.read(textlen, timeout=connection.payload_timeout)
-    if not response:
-        connection.log("Timeout reading ClientCutText data (2)")
+    (buttons, xpos, ypos) = pointerevent_struct.unpack(payload)
+    if connection.options.read_only:
         return
+
+    connection.log("PointerEvent: buttons=%i, pos=%i,%i", buttons, xpos, ypos)
+    queue_event = connection.queue_event
+
+    # We want to be able to discard movement events and report clicks separately
+    # First we deliver any movement events.
+    if xpos != connection.pointer_xpos or ypos != connection.pointer_ypos:
+        queue_event(VNCEventMove(xpos, ypos, buttons))
+        connection.pointer_xpos = xpos
+        connection.pointer_ypos = ypos
+    diff = connection.pointer_buttons ^ buttons
+    connection.pointer_buttons = buttons
+    # Buttons changed, so we need to deliver click or release events
+    # We only visit the bits that changed, lowest button first.
+    while diff:
+        bit = diff & -diff
+        queue_event(VNCEventClick(xpos, ypos, bit.bit_length() - 1, buttons & bit))
+        diff ^= bit
+
+
+@register_msg(VNCConstants.ClientMsgType_ClientCutText, payload_size=3 + 4,
+              tail_size=clientcuttext_tail_size)
+def msg_ClientCutText(connection, payload):
+    # The length is a big endian word following the 3 bytes of padding
+    textlen = int.from_bytes(payload[3:7], 'big')
     if not connection.options.read_only:
-        text = response.decode('iso-8859-1')
-        connection.log("ClientCutText: textlen=%i, text=%r" % (textlen, text))
+        text = payload[7:].decode('iso-8859-1')
+        connection.log("ClientCutText: textlen=%i, text=%r", textlen, text)
         # FIXME: Deliver this data
@@ -29,13 +29,12 @@ class VNCConstants(object):
     ClientMsgType_PointerEvent = 5
     ClientMsgType_ClientCutText = 6
     # Client message types (extensions)
-    ClientMsgType_ResizeFrameBuffer = 4
+    # (ResizeFrameBuffer and VMware each have two numbers; only the later ones are defined here)
     ClientMsgType_KeyFrameUpdate = 5
     ClientMsgType_FileTransfer = 7
     ClientMsgType_TextChat = 11
     ClientMsgType_KeepAlive = 13
     ClientMsgType_ResizeFrameBuffer = 15
-    ClientMsgType_VMware = 127
     ClientMsgType_CarConnectivity = 128
     ClientMsgType_EndOfContinuousUpdates = 150
     ClientMsgType_ServerState = 173
@@ -53,13 +52,12 @@ class VNCConstants(object):
     ServerMsgType_Bell = 2
     ServerMsgType_ServerCutText = 3
     # Server message types (extensions)
-    ServerMsgType_ResizeFrameBuffer = 4
+    # (ResizeFrameBuffer and VMware each have two numbers; only the later ones are defined here)
     ServerMsgType_KeyFrameUpdate = 5
     ServerMsgType_FileTransfer = 7
     ServerMsgType_TextChat = 11
     ServerMsgType_KeepAlive = 13
     ServerMsgType_ResizeFrameBuffer = 15
-    ServerMsgType_VMware = 127
     ServerMsgType_CarConnectivity = 128
     ServerMsgType_EndOfContinuousUpdates = 150
     ServerMsgType_ServerState = 173
@@ -116,4 +114,19 @@ class VNCConstants(object):
     encoding_names = {}
 
 
-VNCConstants.encoding_names = dict((getattr(VNCConstants, name), name) for name in dir(VNCConstants) if name.startswith(('Encoding', 'PseudoEncoding')))
+# Names of the encodings, keyed by their number
+encoding_names = {value: name for name, value in vars(VNCConstants).items()
+                  if name.startswith(('Encoding_', 'PseudoEncoding_'))}
+VNCConstants.encoding_names = encoding_names
+
+# Bits for the client capabilities which the server checks as it runs
+capability_DesktopSize = 1 << 0
+capability_DesktopName = 1 << 1
+capability_Apple1011 = 1 << 2
+
+# The capability bits, keyed by the encoding which the client lists
+capability_bits = {
+    VNCConstants.PseudoEncoding_DesktopSize: capability_DesktopSize,
+    VNCConstants.PseudoEncoding_DesktopName: capability_DesktopName,
+    VNCConstants.PseudoEncoding_Apple1011: capability_Apple1011,
+}
@@ -0,0 +1,160 @@
+"""
+Encodings of the rectangles of pixel data sent in a FramebufferUpdate.
+
+The Raw encoding is handled directly by the connection, as it needs no work beyond the
+pixel format conversion. The other encodings are performed by the encoders in this module,
+which take the converted pixel data for a rectangle.
+
+Some encodings hold state for the whole connection, so each connection creates its own
+encoder from the factories in `encoding_factories`.
+"""
+
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    # We don't have numpy, so tiles will be compared in Python.
+    numpy = None
+
+from .constants import VNCConstants
+
+
+u32_struct = struct.Struct('>L')
+
+
+# 7.7.4. Hextile subencoding flags
+hextile_Raw = 1
+hextile_BackgroundSpecified = 2
+hextile_ForegroundSpecified = 4
+hextile_AnySubrects = 8
+hextile_SubrectsColoured = 16
+
+hextile_size = 16
+
+
+def hextile_uniform_tiles(data, width, height, bytes_per_pixel):
+    """
+    Find which of the tiles are a single colour.
+
+    @param data:            The pixel data for the rectangle
+    @param width:           Width of the rectangle in pixels
+    @param height:          Height of the rectangle in pixels
+    @param bytes_per_pixel: Size of each pixel in the data
+
+    @return: list of rows of tiles, each a list of the tile's colour as bytes, or None
+             if the tile is not a single colour
+    """
+    if numpy:
+        pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width, bytes_per_pixel)
+        # Extend the edges to whole tiles; repeating the last pixels doesn't change whether
+        # the tile is a single colour.
+        tiles_down = -(-height // hextile_size)
+        tiles_across = -(-width // hextile_size)
+        pad_height = tiles_down * hextile_size - height
+        pad_width = tiles_across * hextile_size - width
+        if pad_height or pad_width:
+            pixels = numpy.pad(pixels, ((0, pad_height), (0, pad_width), (0, 0)), mode='edge')
+        tiles = pixels.reshape(tiles_down, hextile_size, tiles_across, hextile_size, bytes_per_pixel)
+        firsts = tiles[:, :1, :, :1, :]
+        uniform = (tiles == firsts).all(axis=(1, 3, 4)).tolist()
+        colours = firsts.reshape(tiles_down, tiles_across, bytes_per_pixel)
+        return [[colours[ty, tx].tobytes() if is_uniform else None
+                 for tx, is_uniform in enumerate(uniform_row)]
+                for ty, uniform_row in enumerate(uniform)]
+
+    data = bytes(data)
+    row_bytes = width * bytes_per_pixel
+    tile_rows = []
+    for ty in range(0, height, hextile_size):
+        rows = [data[offset:offset + row_bytes]
+                for offset in range(ty * row_bytes, min(ty + hextile_size, height) * row_bytes, row_bytes)]
+        tile_row = []
+        for tx in range(0, width * bytes_per_pixel, hextile_size * bytes_per_pixel):
+            tile_end = min(tx + hextile_size * bytes_per_pixel, row_bytes)
+            colour = rows[0][tx:tx + bytes_per_pixel]
+            expected = colour * ((tile_end - tx) // bytes_per_pixel)
+            if all(row[tx:tile_end] == expected for row in rows):
+                tile_row.append(colour)
+            else:
+                tile_row.append(None)
+        tile_rows.append(tile_row)
+    return tile_rows
+
+
+def encode_hextile(data, width, height, bytes_per_pixel):
+    """
+    Encode a rectangle with the Hextile encoding.
+
+    Tiles which are a single colour are sent as just their colour (or nothing at all, if it
+    is the same as the previous tile), and all other tiles are sent raw.
+
+    @param data:            The pixel data for the rectangle, in the client's format
+    @param width:           Width of the rectangle in pixels
+    @param height:          Height of the rectangle in pixels
+    @param bytes_per_pixel: Size of each pixel in the data
+
+    @return: bytes of the encoded rectangle
+    """
+    tile_rows = hextile_uniform_tiles(data, width, height, bytes_per_pixel)
+    data = memoryview(data).cast('B')
+    row_bytes = width * bytes_per_pixel
+
+    out = bytearray()
+    background = None
+    for ty, tile_row in zip(range(0, height, hextile_size), tile_rows):
+        tile_height = min(hextile_size, height - ty)
+        for tx, colour in zip(range(0, width, hextile_size), tile_row):
+            if colour is not None:
+                if colour == background:
+                    # The background carries over from the previous tile
+                    out.append(0)
+                else:
+                    out.append(hextile_BackgroundSpecified)
+                    out += colour
+                    background = colour
+            else:
+                tile_width = min(hextile_size, width - tx)
+                out.append(hextile_Raw)
+                start = ty * row_bytes + tx * bytes_per_pixel
+                end = start + tile_width * bytes_per_pixel
+                for offset in range(0, tile_height * row_bytes, row_bytes):
+                    out += data[start + offset:end + offset]
+                # The background is not defined after a raw tile
+                background = None
+
+    return bytes(out)
+
+
+class ZlibEncoder(object):
+    """
+    Encoder for the zlib encoding.
+
+    The pixel data is compressed as a single zlib stream which lasts for the whole
+    connection, so one of these must be used for each client.
+    """
+    # Fast compression gives most of the benefit for the simple content of most surfaces
+    compression_level = 1
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(self.compression_level)
+
+    def __call__(self, data, width, height, bytes_per_pixel):
+        """
+        Encode a rectangle with the zlib encoding.
+
+        Parameters are the same as encode_hextile.
+
+        @return: bytes of the encoded rectangle
+        """
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return u32_struct.pack(len(compressed)) + compressed
+
+
+# The factories for the encoders for each encoding, other than Raw. Each is called once
+# for a connection, and returns the function which encodes the rectangles.
+encoding_factories = {
+    VNCConstants.Encoding_Hextile: lambda: encode_hextile,
+    VNCConstants.Encoding_zlib: ZlibEncoder,
+}
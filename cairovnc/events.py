@@ -15,6 +15,9 @@ Mouse events:
 import time
 
 
+_time = time.time
+
+
 class VNCEvent(object):
     """
     Base class for events.
@@ -22,14 +25,16 @@ class VNCEvent(object):
     # Name, which should be overridden (may be used to identify the event type without using the class)
     name = 'base'
 
+    __slots__ = ('timestamp',)
+
     def __init__(self):
-        self.timestamp = time.time()
+        self.timestamp = _time()
 
     def __repr__(self):
         return "<{}()>".format(self.__class__.__name__)
 
 
-class VNCEventKey(object):
+class VNCEventKey(VNCEvent):
     """
     A Key input event (press or release).
     """
@@ -89,11 +94,13 @@ class VNCEventKey(object):
     Key_MetaRight_2     = 0xffeb    # Observed on macOS from Real VNC Viewer
     Key_AltLeft_2       = 0xfe03    # Observed on macOS from Real VNC Viewer
 
+    __slots__ = ('key', 'down')
+
     def __init__(self, key, down):
         """
         A key press or release event.
         """
-        super(VNCEventKey, self).__init__()
+        super().__init__()
         self.key = key
         self.down = bool(down)
 
@@ -103,14 +110,16 @@ class VNCEventKey(object):
                                             'down' if self.down else 'up')
 
 
-class VNCEventMove(object):
+class VNCEventMove(VNCEvent):
     """
     A pointer move event.
     """
     name = 'move'
 
+    __slots__ = ('x', 'y', 'buttons')
+
     def __init__(self, x, y, buttons):
-        super(VNCEventMove, self).__init__()
+        super().__init__()
         self.x = x
         self.y = y
         self.buttons = buttons
@@ -120,14 +129,16 @@ class VNCEventMove(object):
                                                  self.x, self.y, self.buttons)
 
 
-class VNCEventClick(object):
+class VNCEventClick(VNCEvent):
     """
     A pointer click event (press or release).
     """
     name = 'click'
 
+    __slots__ = ('x', 'y', 'button', 'down')
+
     def __init__(self, x, y, button, down):
-        super(VNCEventClick, self).__init__()
+        super().__init__()
         self.x = x
         self.y = y
         self.button = button
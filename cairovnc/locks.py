@@ -0,0 +1,89 @@
+"""
+Locks for controlling access to the surface.
+"""
+
+import threading
+
+
+class ReadWriteLockHolder(object):
+    """
+    Context manager which holds a ReadWriteLock in one of its modes.
+    """
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exctype, excvalue, exctb):
+        self.release()
+
+
+class ReadWriteLock(object):
+    """
+    A lock which may be held by many readers at once, or by a single writer.
+
+    The animator should hold the write lock whilst it draws on the surface, and the
+    clients will hold the read lock whilst they fetch the surface data. Once a writer
+    is waiting, new readers wait for it, so that the animator is not starved by the
+    clients.
+
+    Using the lock object directly in a `with` statement takes the write lock, so
+    it may be used in place of a `threading.Lock`.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+        self.read_lock = ReadWriteLockHolder(self.acquire_read, self.release_read)
+        self.write_lock = ReadWriteLockHolder(self.acquire_write, self.release_write)
+
+    def __enter__(self):
+        self.acquire_write()
+        return self
+
+    def __exit__(self, exctype, excvalue, exctb):
+        self.release_write()
+
+    def gen_rlock(self):
+        """
+        Return a context manager which holds the lock for reading.
+        """
+        return self.read_lock
+
+    def gen_wlock(self):
+        """
+        Return a context manager which holds the lock for writing.
+        """
+        return self.write_lock
+
+    def acquire_read(self):
+        with self.condition:
+            while self.writer or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.condition:
+            self.writer = False
+            self.condition.notify_all()
@@ -2,16 +2,72 @@
 Conversions for the pixel data held by the system.
 """
 
+import array
 import struct
+import sys
 
 from .constants import VNCConstants
-from .errors import CairoVNCBadSurfaceFormatError
+from .errors import CairoVNCBadPixelFormatError
+from .pixelkernels import convert_words
+
+try:
+    import numpy
+except ImportError:
+    # We don't have numpy, so conversions will be performed in Python.
+    numpy = None
+
+
+# 7.4 Pixel Format Data Structure
+pixelformat_struct = struct.Struct('>BBBBHHHBBB3s')
+
+
+# Array type code for 32 bit words (usually 'I', but this is platform dependant)
+word_typecode = next((code for code in 'IL' if array.array(code).itemsize == 4), None)
 
 
 def converter_null(rowdata):
     return rowdata
 
 
+def converter_byteswap(rowdata):
+    """
+    Reverse the bytes of each 32 bit word, giving our format in big endian words.
+    """
+    words = array.array(word_typecode)
+    words.frombytes(rowdata)
+    words.byteswap()
+    return words.tobytes()
+
+
+class ByteShuffleConverter(object):
+    """
+    A handler for 32 bit data which only differs from ours in the order of the bytes.
+
+    Each channel is moved to its new byte position with an extended slice, so the
+    conversion is a handful of copies rather than any per-pixel work.
+    """
+
+    def __init__(self, big_endian, pixel_format):
+        # The positions of the channels in our internal data, and in their data
+        self.positions = []
+        for in_byte, shift in ((2, pixel_format.redshift),
+                               (1, pixel_format.greenshift),
+                               (0, pixel_format.blueshift)):
+            out_byte = shift // 8
+            if big_endian:
+                out_byte = 3 - out_byte
+            self.positions.append((in_byte, out_byte))
+
+    def __call__(self, rowdata):
+        """
+        Move the channels from little endian 0x??RRGGBB to their positions in the client format.
+        """
+        out_data = bytearray(len(rowdata))
+        for in_byte, out_byte in self.positions:
+            out_data[out_byte::4] = rowdata[in_byte::4]
+        return bytes(out_data)
+
+
 class GenericConverter(object):
     """
     A handler for generic conversion of bitmap data.
@@ -31,49 +87,126 @@ class GenericConverter(object):
         self.bpp = bpp
         self.big_endian = big_endian
         self.width = -1
-        self.in_format = ''
-        self.out_format = ''
         self.pixel_format = pixel_format
         self.in_redshift = 16 + self.maxshifts[self.pixel_format.redmax]
         self.in_greenshift = 8 + self.maxshifts[self.pixel_format.greenmax]
         self.in_blueshift = 0 + self.maxshifts[self.pixel_format.bluemax]
 
+        if self.bpp not in (8, 16, 32):
+            raise CairoVNCBadPixelFormatError("PixelFormat for {} bit data is not supported".format(self.bpp))
+
+        if convert_words:
+            # Buffers for the compiled conversion, which are reused whilst the width is unchanged
+            self.out_words = None
+            self.out_dtype = numpy.dtype('uint{}'.format(self.bpp))
+            self.byteswap = self.bpp > 8 and self.big_endian != (sys.byteorder == 'big')
+            self.convert = self.convert_compiled
+        elif numpy:
+            # Buffers for the vectorised conversion, which are reused whilst the width is unchanged
+            self.work_words = None
+            self.channel_words = None
+            self.out_words = None
+            self.out_dtype = numpy.dtype('{}u{}'.format('>' if self.big_endian else '<', self.bpp // 8))
+            self.convert = self.convert_numpy
+        else:
+            self.build_tables()
+            self.convert = self.convert_tables
+
     def __call__(self, rowdata):
         """
         Convert from little endian 0x??RRGGBB to correct endianness and bitness.
         """
-        width = int(len(rowdata) / 4)
+        return self.convert(rowdata)
+
+    def convert_compiled(self, rowdata):
+        """
+        Convert the data using the compiled kernel.
+        """
+        in_words = numpy.frombuffer(rowdata, dtype='<u4')
+        width = len(in_words)
         if width != self.width:
-            if self.bpp == 32:
-                pack_format = 'L'
-            elif self.bpp == 16:
-                pack_format = 'H'
-            elif self.bpp == 8:
-                pack_format = 'B'
-            else:
-                raise CairoVNCBadPixelFormatError("PixelFormat for {} bit data is not supported".format(self.width))
-            in_format = '<' + ('L' * width)
-            if self.big_endian:
-                out_format = '>' + (pack_format * width)
-            else:
-                out_format = '<' + (pack_format * width)
-            self.in_format = in_format
-            self.out_format = out_format
+            self.out_words = numpy.empty(width, dtype=self.out_dtype)
             self.width = width
 
-        in_words = struct.unpack(self.in_format, rowdata)
-        out_words = []
-        for word in in_words:
-            r = (word >> self.in_redshift) & self.pixel_format.redmax
-            g = (word >> self.in_greenshift) & self.pixel_format.greenmax
-            b = (word >> self.in_blueshift) & self.pixel_format.bluemax
-            word = ((r<<self.pixel_format.redshift) |
-                    (g<<self.pixel_format.greenshift) |
-                    (b<<self.pixel_format.blueshift))
-            out_words.append(word)
+        convert_words(in_words.astype(numpy.uint32, copy=False), self.out_words,
+                      self.in_redshift, self.in_greenshift, self.in_blueshift,
+                      self.pixel_format.redmax, self.pixel_format.greenmax, self.pixel_format.bluemax,
+                      self.pixel_format.redshift, self.pixel_format.greenshift, self.pixel_format.blueshift)
+        if self.byteswap:
+            return self.out_words.byteswap().tobytes()
+        return self.out_words.tobytes()
 
-        out_data = struct.pack(self.out_format, *out_words)
-        return out_data
+    def convert_numpy(self, rowdata):
+        """
+        Convert the data with vectorised numpy operations.
+        """
+        in_words = numpy.frombuffer(rowdata, dtype='<u4')
+        width = len(in_words)
+        if width != self.width:
+            self.work_words = numpy.empty(width, dtype=numpy.uint32)
+            self.channel_words = numpy.empty(width, dtype=numpy.uint32)
+            self.out_words = numpy.empty(width, dtype=self.out_dtype)
+            self.width = width
+
+        # Each channel is extracted into the channel buffer and merged into the work buffer,
+        # so that no temporary arrays are allocated for the intermediate results.
+        work = self.work_words
+        channel = self.channel_words
+        work.fill(0)
+        for in_shift, channelmax, shift in ((self.in_redshift, self.pixel_format.redmax, self.pixel_format.redshift),
+                                            (self.in_greenshift, self.pixel_format.greenmax, self.pixel_format.greenshift),
+                                            (self.in_blueshift, self.pixel_format.bluemax, self.pixel_format.blueshift)):
+            numpy.right_shift(in_words, in_shift, out=channel)
+            numpy.bitwise_and(channel, channelmax, out=channel)
+            numpy.left_shift(channel, shift, out=channel)
+            numpy.bitwise_or(work, channel, out=work)
+        self.out_words[...] = work
+        return self.out_words.tobytes()
+
+    def build_tables(self):
+        """
+        Build the lookup tables for the conversion without numpy.
+
+        For each byte of the output word, we build a table for each input channel which
+        gives that channel's contribution to the byte.
+        """
+        out_bytes = self.bpp // 8
+        channels = ((2, self.in_redshift - 16, self.pixel_format.redmax, self.pixel_format.redshift),
+                    (1, self.in_greenshift - 8, self.pixel_format.greenmax, self.pixel_format.greenshift),
+                    (0, self.in_blueshift, self.pixel_format.bluemax, self.pixel_format.blueshift))
+
+        # List of (output byte position, list of (input byte position, table))
+        self.tables = []
+        for out_byte in range(out_bytes):
+            byte_shift = out_byte * 8
+            position = out_bytes - 1 - out_byte if self.big_endian else out_byte
+            tables = []
+            for in_byte, in_shift, channelmax, shift in channels:
+                table = bytes(((((value >> in_shift) & channelmax) << shift) >> byte_shift) & 255
+                              for value in range(256))
+                if any(table):
+                    tables.append((in_byte, table))
+            self.tables.append((position, tables))
+
+    def convert_tables(self, rowdata):
+        """
+        Convert the data through lookup tables.
+
+        Each channel is extracted with a slice and translated through its table. The
+        contributions to each output byte are combined by treating the translated channels
+        as large integers, so all the per-pixel work happens in C.
+        """
+        rowdata = bytes(rowdata)
+        width = len(rowdata) // 4
+        out_bytes = self.bpp // 8
+        out_data = bytearray(width * out_bytes)
+        for position, tables in self.tables:
+            value = 0
+            for in_byte, table in tables:
+                value |= int.from_bytes(rowdata[in_byte::4].translate(table), 'little')
+            if value:
+                out_data[position::out_bytes] = value.to_bytes(width, 'little')
+        return bytes(out_data)
 
 
 class PixelFormat(object):
@@ -89,6 +222,13 @@ class PixelFormat(object):
     greenshift = 8
     blueshift = 0
     padding = b'\x00\x00\x00'
+    # The encoding of the default parameters, which is the same for every client
+    default_encoded = None
+    # The parameters which make up the format; setting any of them discards the cached
+    # encoding and converter
+    format_attributes = frozenset(('bpp', 'depth', 'endianness', 'truecolour',
+                                   'redmax', 'greenmax', 'bluemax',
+                                   'redshift', 'greenshift', 'blueshift', 'padding'))
 
     def __init__(self, data=None):
         """
@@ -97,9 +237,19 @@ class PixelFormat(object):
         See 7.4 Pixel Format Data Structure.
         """
         self._converter = None
+        self._encoded = self.default_encoded
+        # Converters we have built for this client, keyed by the format they were built for.
+        # These are not shared between clients, because the converters hold working buffers.
+        self._converters = {}
         if data:
             self.decode(data)
 
+    def __setattr__(self, name, value):
+        if name in self.format_attributes:
+            self._encoded = None
+            self._converter = None
+        super().__setattr__(name, value)
+
     def __repr__(self):
         return "<{}({} bpp, {} red(shift {}), {} green(shift {}), {} blue(shift {}))>".format(self.__class__.__name__,
                                                                                               self.bpp,
@@ -111,29 +261,42 @@ class PixelFormat(object):
         (self.bpp, self.depth, bigendian, truecolour,
          self.redmax, self.greenmax, self.bluemax,
          self.redshift, self.greenshift, self.blueshift,
-         _) = struct.unpack('>BBBBHHHBBB3s', data)
+         _) = pixelformat_struct.unpack(data)
         self.truecolour = VNCConstants.PixelFormat_TrueColour if truecolour else VNCConstants.PixelFormat_Paletted
         self.endianness = VNCConstants.PixelFormat_BigEndian if bigendian else VNCConstants.PixelFormat_LittleEndian
-        self._converter = None
 
     def encode(self):
-        data = struct.pack('>BBBBHHHBBB3s',
-                           self.bpp, self.depth, self.endianness, self.truecolour,
-                           self.redmax, self.greenmax, self.bluemax,
-                           self.redshift, self.greenshift, self.blueshift,
-                           self.padding)
-        return data
+        if not self._encoded:
+            self._encoded = pixelformat_struct.pack(self.bpp, self.depth, self.endianness, self.truecolour,
+                                                    self.redmax, self.greenmax, self.bluemax,
+                                                    self.redshift, self.greenshift, self.blueshift,
+                                                    self.padding)
+        return self._encoded
 
     @property
     def converter(self):
         """
         Return a function which will convert from the internal format we're using to what they requested.
 
-        The converter should be passed a row of data as a bytes object.
+        The converter should be passed one or more rows of data as a bytes object.
         """
         if self._converter:
             return self._converter
 
+        key = (self.bpp, self.depth, self.endianness, self.truecolour,
+               self.redmax, self.greenmax, self.bluemax,
+               self.redshift, self.greenshift, self.blueshift)
+        self._converter = self._converters.get(key)
+        if not self._converter:
+            self._converter = self.build_converter()
+            self._converters[key] = self._converter
+
+        return self._converter
+
+    def build_converter(self):
+        """
+        Construct the converter for the current format.
+        """
         if not self.truecolour:
             raise CairoVNCBadPixelFormatError("Paletted PixelFormats are not supported")
 
@@ -143,7 +306,7 @@ class PixelFormat(object):
            self.greenmax == 255 and self.greenshift == 8 and \
            self.bluemax == 255 and self.blueshift == 0:
             # This is the same format as our internal data, so it's a pass through
-            self._converter = converter_null
+            return converter_null
 
         elif self.bpp == 32 and \
              self.endianness == VNCConstants.PixelFormat_BigEndian and \
@@ -151,10 +314,24 @@ class PixelFormat(object):
              self.greenmax == 255 and self.greenshift == 16 and \
              self.bluemax == 255 and self.blueshift == 24:
             # This means the exact same thing, but represented in bigendian words
-            self._converter = converter_null
+            return converter_null
 
-        else:
-            self._converter = GenericConverter(self.endianness == VNCConstants.PixelFormat_BigEndian, self.bpp,
-                                               self)
+        elif self.bpp == 32 and word_typecode and \
+             self.endianness == VNCConstants.PixelFormat_BigEndian and \
+             self.redmax == 255 and self.redshift == 16 and \
+             self.greenmax == 255 and self.greenshift == 8 and \
+             self.bluemax == 255 and self.blueshift == 0:
+            # Our format, but in bigendian words, so we only need to reverse the bytes
+            return converter_byteswap
 
-        return self._converter
+        elif self.bpp == 32 and \
+             self.redmax == 255 and self.greenmax == 255 and self.bluemax == 255 and \
+             all(shift in (0, 8, 16, 24) for shift in (self.redshift, self.greenshift, self.blueshift)) and \
+             len(set((self.redshift, self.greenshift, self.blueshift))) == 3:
+            # The channels are whole bytes, so we only need to move them around
+            return ByteShuffleConverter(self.endianness == VNCConstants.PixelFormat_BigEndian, self)
+
+        return GenericConverter(self.endianness == VNCConstants.PixelFormat_BigEndian, self.bpp, self)
+
+
+PixelFormat.default_encoded = PixelFormat().encode()
@@ -0,0 +1,98 @@
+"""
+Compiled kernels for the conversion and comparison of pixel data.
+
+These kernels are only available if numba is installed. If it is not, the kernel
+functions will be None, and the callers should fall back to their own implementations.
+"""
+
+try:
+    import numba
+    import numpy
+except ImportError:
+    # We don't have the JIT compiler.
+    numba = None
+    numpy = None
+
+
+# The number of words at which the conversion is worth spreading over multiple threads
+parallel_threshold = 65536
+
+
+if numba:
+    @numba.njit(cache=True)
+    def convert_words_serial(in_words, out_words,
+                             in_redshift, in_greenshift, in_blueshift,
+                             redmax, greenmax, bluemax,
+                             redshift, greenshift, blueshift):
+        """
+        Convert 0x??RRGGBB words into words of a different pixel format.
+
+        @param in_words:    uint32 array of the words in the internal format
+        @param out_words:   uint32, uint16 or uint8 array to write the converted words to
+        @param in_*shift:   Shift to apply to the input word to extract the most significant bits
+                            of the channel
+        @param *max:        Maximum value of the channel in the output format
+        @param *shift:      Shift of the channel in the output format
+        """
+        for i in range(in_words.shape[0]):
+            word = in_words[i]
+            out_words[i] = ((((word >> in_redshift) & redmax) << redshift) |
+                            (((word >> in_greenshift) & greenmax) << greenshift) |
+                            (((word >> in_blueshift) & bluemax) << blueshift))
+
+    @numba.njit(parallel=True, cache=True)
+    def convert_words_parallel(in_words, out_words,
+                               in_redshift, in_greenshift, in_blueshift,
+                               redmax, greenmax, bluemax,
+                               redshift, greenshift, blueshift):
+        """
+        Convert 0x??RRGGBB words into words of a different pixel format, using multiple threads.
+
+        Parameters are the same as convert_words_serial.
+        """
+        for i in numba.prange(in_words.shape[0]):
+            word = in_words[i]
+            out_words[i] = ((((word >> in_redshift) & redmax) << redshift) |
+                            (((word >> in_greenshift) & greenmax) << greenshift) |
+                            (((word >> in_blueshift) & bluemax) << blueshift))
+
+    def convert_words(in_words, out_words, *args):
+        """
+        Convert 0x??RRGGBB words into words of a different pixel format.
+
+        Small conversions are performed on the calling thread, as the cost of starting the
+        parallel threads would outweigh their benefit.
+
+        Parameters are the same as convert_words_serial.
+        """
+        if in_words.shape[0] >= parallel_threshold:
+            convert_words_parallel(in_words, out_words, *args)
+        else:
+            convert_words_serial(in_words, out_words, *args)
+
+    @numba.njit(cache=True)
+    def find_changed_rows(words, changed):
+        """
+        Find the rows which differ from the row before them.
+
+        Each row is only compared until the first difference is found.
+
+        @param words:   2D array of the surface data, one row of words per surface row
+        @param changed: bool array to write whether each row differs from the row before;
+                        the first row is always marked as changed
+        """
+        height = words.shape[0]
+        width = words.shape[1]
+        if height:
+            changed[0] = True
+        for y in range(1, height):
+            diff = False
+            for x in range(width):
+                if words[y, x] != words[y - 1, x]:
+                    diff = True
+                    break
+            changed[y] = diff
+
+else:
+    convert_words = None
+    find_changed_rows = None
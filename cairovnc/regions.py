@@ -2,11 +2,16 @@
 Management of the redraw regions requested by the client.
 """
 
+import collections
+
 
 class RegionRequest(object):
     """
     Container for a region which the client has requested.
+
+    The region should be treated as immutable; it may be compared and hashed.
     """
+    __slots__ = ('incremental', 'x0', 'y0', 'width', 'height', 'x1', 'y1')
 
     def __init__(self, incremental, x, y, width, height):
         self.incremental = bool(incremental)
@@ -14,6 +19,8 @@ class RegionRequest(object):
         self.y0 = y
         self.width = width
         self.height = height
+        self.x1 = x + width
+        self.y1 = y + height
 
     def __repr__(self):
         return "<{}(incremental={}, pos={},{}, size={},{})>".format(self.__class__.__name__,
@@ -21,24 +28,57 @@ class RegionRequest(object):
                                                                     self.x0, self.y0,
                                                                     self.width, self.height)
 
-    @property
-    def x1(self):
-        return self.x0 + self.width
+    def __eq__(self, other):
+        if not isinstance(other, RegionRequest):
+            return NotImplemented
+        return (self.incremental == other.incremental and
+                self.x0 == other.x0 and self.y0 == other.y0 and
+                self.width == other.width and self.height == other.height)
+
+    def __hash__(self):
+        return hash((self.incremental, self.x0, self.y0, self.width, self.height))
+
+    def contains(self, other):
+        """
+        Whether the other region lies entirely within this one.
+        """
+        return (self.x0 <= other.x0 and self.y0 <= other.y0 and
+                self.x1 >= other.x1 and self.y1 >= other.y1)
 
-    @property
-    def y1(self):
-        return self.y0 + self.height
+    def overlaps(self, other):
+        """
+        Whether the other region shares any area with this one.
+        """
+        return (self.x0 < other.x1 and other.x0 < self.x1 and
+                self.y0 < other.y1 and other.y0 < self.y1)
+
+    def union(self, other):
+        """
+        Return the bounding region of this region and another with the same incremental flag.
+        """
+        x0 = min(self.x0, other.x0)
+        y0 = min(self.y0, other.y0)
+        x1 = max(self.x1, other.x1)
+        y1 = max(self.y1, other.y1)
+        return RegionRequest(self.incremental, x0, y0, x1 - x0, y1 - y0)
 
 
 class Regions(object):
     """
     Manager for the regions.
 
-    Essentially this is a list of region requests, but it may perform coalescing and discarding
-    of earlier regions. At present it does not.
+    Essentially this is a queue of region requests, which are coalesced when they are drawn.
+    Requests which are already covered are discarded as they are added, and overlapping
+    requests are merged, so that a client which sends many requests does not build up a
+    long queue.
     """
+    __slots__ = ('regions',)
+
+    # The number of separate regions we'll hold before merging them all
+    max_regions = 16
+
     def __init__(self):
-        self.regions = []
+        self.regions = collections.deque()
 
     def __repr__(self):
         return "<{}({} regions)>".format(self.__class__.__name__,
@@ -46,13 +86,70 @@ class Regions(object):
 
     def __bool__(self):
         return bool(self.regions)
-    __nonzero__ = __bool__  # Python 2 compatibility
 
     def add(self, region):
+        """
+        Add a region request, merging it with those we already hold.
+
+        @param region:  RegionRequest to add
+        """
+        merged = True
+        while merged:
+            merged = False
+            for existing in self.regions:
+                if (not existing.incremental or region.incremental) and existing.contains(region):
+                    # Everything in this region will be drawn by the existing request
+                    return
+                if existing.incremental == region.incremental and existing.overlaps(region):
+                    # Replace the existing request with the union, which might now overlap others
+                    self.regions.remove(existing)
+                    region = existing.union(region)
+                    merged = True
+                    break
+
         self.regions.append(region)
+        if len(self.regions) > self.max_regions:
+            self.regions = collections.deque(self.merged())
 
     def pop(self):
-        return self.regions.pop(0)
+        return self.regions.popleft()
 
     def clear(self):
-        self.regions = []
+        self.regions.clear()
+
+    def coalesce(self):
+        """
+        Merge the requested regions into as few regions as possible, and clear the requests.
+
+        @return: list of at most two RegionRequest objects to draw
+        """
+        merged = self.merged()
+        self.regions.clear()
+        return merged
+
+    def merged(self):
+        """
+        Merge the requested regions into as few regions as possible.
+
+        The non-incremental and incremental requests are each merged into their bounding
+        region. If the incremental region lies within the non-incremental region it is
+        discarded, as that area will be redrawn in full anyway.
+
+        @return: list of at most two RegionRequest objects to draw
+        """
+        merged = []
+        for incremental in (False, True):
+            regions = [region for region in self.regions if region.incremental == incremental]
+            if not regions:
+                continue
+            x0 = min(region.x0 for region in regions)
+            y0 = min(region.y0 for region in regions)
+            x1 = max(region.x1 for region in regions)
+            y1 = max(region.y1 for region in regions)
+            if merged and \
+               merged[0].x0 <= x0 and merged[0].y0 <= y0 and \
+               merged[0].x1 >= x1 and merged[0].y1 >= y1:
+                continue
+            merged.append(RegionRequest(incremental, x0, y0, x1 - x0, y1 - y0))
+
+        return merged
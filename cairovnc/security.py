@@ -2,52 +2,113 @@
 Handlers for the security.
 """
 
-import random
-import struct
+import collections
+import os
+import threading
+
+from .constants import VNCConstants
+
+# The DES implementations are tried in order of speed; the C implementations in pycryptodome
+# and cryptography are much faster than the pure Python des module.
 try:
-    import secrets
+    from Crypto.Cipher import DES as crypto_des
 except ImportError:
-    # Secrets isn't available before 3.6
-    secrets = None
+    crypto_des = None
 
-from .constants import VNCConstants
-from .regions import RegionRequest
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, modes
+    try:
+        from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+    except ImportError:
+        # Older versions of cryptography held TripleDES with the other algorithms
+        from cryptography.hazmat.primitives.ciphers.algorithms import TripleDES
+except ImportError:
+    Cipher = None
 
 try:
     import des
 except ImportError:
-    # We don't have an encryption library.
     des = None
 
 
-def get_challenge(len):
+def get_challenge(nbytes):
     """
     Return a random challenge, of a given number of bytes.
     """
-    if secrets:
-        return secrets.token_bytes(len)
-    # random.randbytes only exists from 3.9 onward, by which point we should
-    # use secrets, which is already handled.
+    return os.urandom(nbytes)
+
 
-    return bytes(bytearray([random.randrange(256) for _ in range(len)]))
+def des_cipher_pycryptodome(key):
+    return crypto_des.new(key, crypto_des.MODE_ECB).encrypt
+
+
+def des_cipher_cryptography(key):
+    # Triple DES with the same key three times is single DES
+    cipher = Cipher(TripleDES(key * 3), modes.ECB())
+
+    def encrypt(value):
+        encryptor = cipher.encryptor()
+        return encryptor.update(value) + encryptor.finalize()
+    return encrypt
+
+
+def des_cipher_des(key):
+    return des.DesKey(key).encrypt
+
+
+if crypto_des:
+    des_cipher = des_cipher_pycryptodome
+elif Cipher:
+    des_cipher = des_cipher_cryptography
+elif des:
+    des_cipher = des_cipher_des
+else:
+    # We don't have an encryption library.
+    des_cipher = None
+
+# The encryption functions for the keys we have used most recently, so that the key
+# schedule is only computed once for each password. Only a few are kept, as the server has
+# at most two passwords at a time, and the key material shouldn't outlive a changed password.
+des_ciphers = collections.OrderedDict()
+des_ciphers_max = 4
+des_ciphers_lock = threading.Lock()
 
 
 def des_encrypt(key, value):
-    key = des.DesKey(key)
-    result = key.encrypt(value)
-    return result
+    """
+    Encrypt a value with DES.
+
+    Thread: Connection thread
+
+    @param key:     8 byte key
+    @param value:   bytes to encrypt, a multiple of 8 bytes long
+
+    @return: encrypted bytes
+    """
+    with des_ciphers_lock:
+        encrypt = des_ciphers.get(key)
+        if encrypt:
+            des_ciphers.move_to_end(key)
+        else:
+            encrypt = des_cipher(key)
+            des_ciphers[key] = encrypt
+            while len(des_ciphers) > des_ciphers_max:
+                des_ciphers.popitem(last=False)
+    return encrypt(value)
+
+
+def bitrev8(b):
+    """
+    Reverse the order of the bits in a byte.
+
+    The multiply spreads copies of the byte, the mask picks out each bit in its reversed
+    position and the modulus gathers them back together.
+    """
+    return ((b * 0x0202020202) & 0x010884422010) % 1023
 
 
-# Table for reversing the order of bits in a byte.
-bit_reverse = dict((b, ((b & 1)<<7) |
-                       ((b & 2)<<5) |
-                       ((b & 4)<<3) |
-                       ((b & 8)<<1) |
-                       ((b & 16)>>1) |
-                       ((b & 32)>>3) |
-                       ((b & 64)>>5) |
-                       ((b & 128)>>7)
-                    ) for b in range(256))
+# Table for reversing the order of bits in a byte, for use with bytes.translate.
+bit_reverse = bytes(bitrev8(b) for b in range(256))
 
 
 def invert_password(password):
@@ -57,15 +118,23 @@ def invert_password(password):
     The VNC protocol's use of DES has the key with bits in the opposite
     order to the expectations of DES.
     """
-    return bytes(bytearray(bit_reverse[b] for b in bytearray(password)))
+    return bytes(password).translate(bit_reverse)
 
 
 security_handlers = {}
 
 
-def register_security(sectype):
+def register_security(sectype, available=True):
+    """
+    Register a class which handles a security type.
+
+    @param sectype:     The security type number
+    @param available:   False if the handler cannot work in this environment (eg because a
+                        library it needs is missing), in which case it is never offered
+    """
     def register_cls(cls):
-        security_handlers[sectype] = cls
+        if available:
+            security_handlers[sectype] = cls
         return cls
     return register_cls
 
@@ -81,8 +150,8 @@ class SecurityBase(object):
         if self.name.startswith('Security'):
             self.name = self.name[8:]
 
-    def log(self, message):
-        self.server.log("Security({}): {}".format(self.name, message))
+    def log(self, message, *args):
+        self.server.log("Security(%s): " + message, self.name, *args)
 
     def enabled(self):
         """
@@ -111,14 +180,11 @@ class SecurityNone(SecurityBase):
         return None
 
 
-@register_security(VNCConstants.Security_VNCAuthentication)
+# We cannot authenticate without an encryption library
+@register_security(VNCConstants.Security_VNCAuthentication, available=bool(des_cipher))
 class SecurityVNCAuthentication(SecurityBase):
 
     def enabled(self):
-        if not des:
-            # We cannot authenticate without encryption using the des library
-            return False
-
         # We're only activating this authentication if there is a password set
         return bool(self.server.options.password or self.server.options.password_readonly)
 
@@ -148,11 +214,11 @@ class SecurityVNCAuthentication(SecurityBase):
 
             if False:
                 # If you need to debug what's going on with these encryptions, enable this code
-                self.log("challenge=%r" % (challenge,))
-                self.log("password_padded=%r" % (password_padded,))
-                self.log("password_reversed=%r" % (password_reversed,))
-                self.log("expected=%r" % (expect,))
-                self.log("received=%r" % (response,))
+                self.log("challenge=%r", challenge)
+                self.log("password_padded=%r", password_padded)
+                self.log("password_reversed=%r", password_reversed)
+                self.log("expected=%r", expect)
+                self.log("received=%r", response)
 
             if expect == response:
                 password_accepted = password
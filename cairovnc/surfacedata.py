@@ -2,12 +2,54 @@
 Surface conversion to data that we can return to the user.
 """
 
+import itertools
+import sys
 import time
 
 import cairo
 
+try:
+    import numpy
+except ImportError:
+    # We don't have numpy, so rows will be compared individually.
+    numpy = None
+
 from .constants import VNCConstants
 from .errors import CairoVNCBadSurfaceFormatError
+from .pixelkernels import find_changed_rows
+
+try:
+    from ._surfacedata import split_rows as split_rows_compiled
+except ImportError:
+    # The Cython extension has not been built.
+    split_rows_compiled = None
+
+
+# Source of the frame versions, shared by all the surfaces so that a new surface never
+# reuses the version of an old one.
+frame_versions = itertools.count(1)
+
+
+def changed_columns_numpy(new_rows, old_rows, width):
+    """
+    Find the columns which differ between two sets of rows.
+
+    @param new_rows:    list of rows of bytes() from the current frame
+    @param old_rows:    list of rows of bytes() which the client has
+    @param width:       Width of the rows in pixels
+
+    @return: tuple of (first column, column after the last) which changed
+    """
+    new = numpy.frombuffer(b''.join(new_rows), dtype=numpy.uint32).reshape(len(new_rows), -1)
+    old = numpy.frombuffer(b''.join(old_rows), dtype=numpy.uint32).reshape(len(old_rows), -1)
+    columns = numpy.flatnonzero((new[:, :width] != old[:, :width]).any(axis=0))
+    if not len(columns):
+        return (0, 0)
+    return (int(columns[0]), int(columns[-1]) + 1)
+
+
+# Without numpy, comparing the columns would cost more than sending the whole rows
+changed_columns = changed_columns_numpy if numpy else None
 
 
 class SurfaceData(object):
@@ -28,21 +70,43 @@ class SurfaceData(object):
         Construct an object access to the data on the surface.
 
         @param surface:         The surface we're getting information on
-        @param lock:            A lock to use when accessing the surface
+        @param lock:            A lock to use when accessing the surface; if it is a
+                                ReadWriteLock, only the read lock is taken
         @param max_framerate:   Maximum speed at which data will be returned
         """
         self.surface = surface
         self.lock = lock
+        if hasattr(lock, 'gen_rlock'):
+            # We only read the surface, so can share it with the other readers
+            self.lock = lock.gen_rlock()
         self.data = None
-        self.last_data_time = 0
+        # A copy of the surface buffer that self.data was built from
+        self.last_buffer = None
+        # Changes whenever self.data is rebuilt
+        self.frame_version = 0
+        # View of last_buffer, if the rows lie contiguously within it
+        self.pixels = None
+        # Working buffer for clearing the alpha channel, when numpy is available
+        self.alpha_words = None
+        self.last_data_time = 0     # Monotonic time of the last fetch, in nanoseconds
         self._max_framerate = 1
         self._min_period = 1
+        self._min_period_ns = 1000000000
 
         self.max_framerate = max_framerate
 
         with self.lock:
             self.width = self.surface.get_width()
             self.height = self.surface.get_height()
+            self.format = self.surface.get_format()
+            # The surface's buffer and layout cannot change (a new surface would be a new
+            # SurfaceData object), so we only need to ask for them once.
+            self.stride = self.surface.get_stride()
+            self.surface_buffer = self.surface.get_data()
+
+        if self.format not in (cairo.FORMAT_RGB24, cairo.FORMAT_ARGB32):
+            # Unrecognised format.
+            raise CairoVNCBadSurfaceFormatError("Cairo surface format {} is not supported".format(self.format))
 
     @property
     def max_framerate(self):
@@ -52,6 +116,7 @@ class SurfaceData(object):
     def max_framerate(self, value):
         self._max_framerate = value
         self._min_period = 1.0 / value
+        self._min_period_ns = int(1e9 / value)
 
     @property
     def min_period(self):
@@ -60,6 +125,7 @@ class SurfaceData(object):
     @min_period.setter
     def min_period(self, value):
         self._min_period = value
+        self._min_period_ns = int(value * 1e9)
         self._max_framerate = 1.0 / value
 
     def get_size(self):
@@ -74,51 +140,136 @@ class SurfaceData(object):
 
         @return: tuple of (width, height, list of rows of bytes())
         """
-        now = time.time()
-        if now - self.last_data_time < self.min_period:
+        (width, height, data, _, _) = self.get_frame()
+        return (width, height, data)
+
+    def get_frame(self):
+        """
+        Retrieve the data in rows, with the version of the frame it came from.
+
+        The version only changes when the content of the surface has changed, so a client
+        which has already sent a version of the frame need not look at the rows again.
+
+        If the rows have no padding between them, the whole frame is also supplied as a
+        memoryview, so that a run of rows can be sent without joining them together.
+
+        @return: tuple of (width, height, list of rows of bytes(), frame version,
+                           memoryview of all the rows or None)
+        """
+        now = time.monotonic_ns()
+        if self.data is not None and now - self.last_data_time < self._min_period_ns:
             # This is a request within the frame period, so return the last data we got
-            return (self.width, self.height, self.data)
+            return (self.width, self.height, self.data, self.frame_version, self.pixels)
 
+        data = self.surface_buffer
+        stride = self.stride
         with self.lock:
-            data_format = self.surface.get_format()
-            data = self.surface.get_data()
-            stride = self.surface.get_stride()
-
-            if data_format == cairo.FORMAT_RGB24:
-                def converter(row):
-                    return bytes(row)
-
-            elif data_format == cairo.FORMAT_ARGB32:
-                def converter(row):
-                    # FIXME: Not quite correct; as this leaves the alpha channel in the 4th byte.
-                    return bytes(row)
+            # Copy the data (because the buffer object or memoryview will change after we return).
+            # Everything else works from this copy, so the surface is only locked whilst we take it.
+            if self.format == cairo.FORMAT_ARGB32:
+                buffer = self.copy_without_alpha(data)
             else:
-                # Unrecognised format.
-                raise CairoVNCBadSurfaceFormatError("Cairo surface format {} is not supported".format(data_format))
+                buffer = bytes(data)
 
+        # If nothing has been drawn since we last read the surface, the rows we built
+        # last time are still correct. Returning the same row objects also makes the
+        # clients' comparisons of the rows trivial.
+        # (We compare the whole buffer, as any sampled fingerprint could miss changes.)
+        if self.data is None or buffer != self.last_buffer:
             # We split the returned data into rows as this will be easier for the clients to
             # compare and render only the changes.
-            row_data = []
-            lastdata = 0    # The prior row's input data
-            lastrow = 0     # The prior row's converted data
-            for y in range(self.height):
-                offset = y * stride
-                row = data[offset:offset + stride]
-                if row == lastdata:
-                    # If it's actually the same as the prior row, then make it the same object
-                    row = lastrow
-                else:
-                    # Copy the data (because the buffer object or memoryview will change after we return)
-                    lastdata = row
-                    row = converter(row)
-                    lastrow = row
-                row_data.append(row)
-
-            self.data = row_data
+            if split_rows_compiled:
+                self.data = split_rows_compiled(buffer, self.height, stride)
+            elif numpy:
+                self.data = self.split_rows_numpy(buffer, stride)
+            else:
+                self.data = self.split_rows(buffer, stride)
+            self.last_buffer = buffer
+            self.frame_version = next(frame_versions)
+            if stride == self.width * 4:
+                self.pixels = memoryview(buffer)[:self.height * stride]
+            else:
+                self.pixels = None
 
         # It may have taken a long time to process this data, so we'll reset the time
         # it was fetched to the end of the fetch.
-        now = time.time()
-        self.last_data_time = now
+        self.last_data_time = time.monotonic_ns()
 
-        return (self.width, self.height, self.data)
+        return (self.width, self.height, self.data, self.frame_version, self.pixels)
+
+    def copy_without_alpha(self, data):
+        """
+        Copy the surface data, clearing the alpha channel to give B, G, R, 0 pixels.
+
+        If the alpha were left in place, rows which only differed in their alpha would
+        be sent to the clients as changed.
+
+        @param data:    The surface data buffer
+
+        @return: bytes of the data without alpha
+        """
+        if numpy:
+            words = numpy.frombuffer(data, dtype=numpy.uint32)
+            if self.alpha_words is None or len(self.alpha_words) != len(words):
+                self.alpha_words = numpy.empty(len(words), dtype=numpy.uint32)
+            numpy.bitwise_and(words, numpy.uint32(0x00FFFFFF), out=self.alpha_words)
+            return self.alpha_words.tobytes()
+
+        buffer = bytearray(data)
+        # The alpha is the top byte of the native-endian words
+        alpha = 3 if sys.byteorder == 'little' else 0
+        buffer[alpha::4] = bytes(len(buffer) // 4)
+        return bytes(buffer)
+
+    def split_rows(self, data, stride):
+        """
+        Split the surface data into rows, sharing the objects for rows which repeat.
+
+        The rows are sliced from our copy of the surface, as comparing bytes objects is a
+        simple memory comparison, which is far faster than comparing memoryview slices.
+
+        @param data:        Copy of the surface data, as bytes
+        @param stride:      Number of bytes between the rows
+
+        @return: list of rows of bytes()
+        """
+        row_data = []
+        lastrow = None
+        for offset in range(0, self.height * stride, stride):
+            row = data[offset:offset + stride]
+            if row == lastrow:
+                # If it's actually the same as the prior row, then make it the same object
+                row = lastrow
+            else:
+                lastrow = row
+            row_data.append(row)
+
+        return row_data
+
+    def split_rows_numpy(self, data, stride):
+        """
+        Split the surface data into rows, using numpy to find the rows which repeat.
+
+        All the rows are compared with the row before them in one vectorised operation, or
+        with the compiled kernel if numba is available.
+
+        Parameters and return are the same as split_rows.
+        """
+        # Cairo's strides are always a multiple of 4 bytes; compare the widest words we can
+        dtype = numpy.uint64 if stride % 8 == 0 else numpy.uint32
+        words = numpy.frombuffer(data, dtype=dtype,
+                                 count=self.height * stride // dtype().itemsize).reshape(self.height, -1)
+        changed = numpy.ones(self.height, dtype=bool)
+        if find_changed_rows:
+            find_changed_rows(words, changed)
+        else:
+            numpy.any(words[1:] != words[:-1], axis=1, out=changed[1:])
+
+        row_data = []
+        row = None
+        for y, row_changed in enumerate(changed.tolist()):
+            if row_changed:
+                offset = y * stride
+                row = data[offset:offset + stride]
+            row_data.append(row)
+        return row_data
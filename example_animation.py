@@ -25,20 +25,28 @@ class Screen(object):
 
         self.surface = cairo.ImageSurface(cairo.Format.ARGB32, self.width, self.height)
         self.context = cairo.Context(self.surface)
+        # All the drawing is in units of the surface size, which never changes
+        self.context.scale(self.width, self.height)
+
+        # The colours are created once, rather than on every frame
+        self.background = cairo.SolidPattern(0.5, 0.5, 0.5)
+        self.white = cairo.SolidPattern(1, 1, 1)
+        self.control = cairo.SolidPattern(1, 0.2, 0.2, 0.6)
+        self.red = cairo.SolidPattern(1, 0, 0)
+        self.green = cairo.SolidPattern(0, 1, 0)
+        self.blue = cairo.SolidPattern(0, 0, 1)
 
     def draw(self):
-        self.context.set_source_rgb(0.5, 0.5, 0.5)
-        self.context.rectangle(0, 0, self.width, self.height)
+        self.context.set_source(self.background)
+        self.context.rectangle(0, 0, 1, 1)
         self.context.fill()
 
-        self.context.set_source_rgb(1, 1, 1)
+        self.context.set_source(self.white)
 
         delta = math.cos(self.seq * math.pi / 10)
 
         x, y, x1, y1 = 0.1, 0.5, 0.4, 0.5 + delta * 0.4
         x2, y2, x3, y3 = 0.6, 0.1, 0.9, 0.5
-        self.context.save()
-        self.context.scale(self.width, self.height)
 
         # Bezier curve
         self.context.set_line_width(0.04)
@@ -47,7 +55,7 @@ class Screen(object):
         self.context.stroke()
 
         # Control points
-        self.context.set_source_rgba(1, 0.2, 0.2, 0.6)
+        self.context.set_source(self.control)
         self.context.set_line_width(0.02)
         self.context.move_to(x, y)
         self.context.line_to(x1, y1)
@@ -56,26 +64,34 @@ class Screen(object):
         self.context.stroke()
 
         # Red square
-        self.context.set_source_rgb(1, 0, 0)
+        self.context.set_source(self.red)
         self.context.rectangle(0.1, 0 + delta * 0.05, 0.1, 0.1)
         self.context.fill()
 
         # Green square
-        self.context.set_source_rgb(0, 1, 0)
+        self.context.set_source(self.green)
         self.context.rectangle(0.3, 0, 0.1, 0.1)
         self.context.fill()
 
         # Blue square
-        self.context.set_source_rgb(0, 0, 1)
+        self.context.set_source(self.blue)
         self.context.rectangle(0.5, 0, 0.1, 0.1)
         self.context.fill()
-        self.context.restore()
 
         #self.surface.write_to_png('image.png')
 
     def animate(self):
+        # Frames are scheduled from a fixed start, so the time taken to draw them
+        # doesn't slow the animation down.
+        next_frame = time.monotonic()
         while True:
-            time.sleep(self.animation_period)
+            next_frame += self.animation_period
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # We've fallen behind, so start the schedule again from now
+                next_frame = time.monotonic()
             self.draw()
             self.seq += 1
 
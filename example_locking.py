@@ -7,8 +7,13 @@ Then run a server on localhost:5902 / localhost:2 which should display the anima
 Here we use a thread to lock access to the surface whilst it's being updated.
 These locks ensure that the threads which are supplying data to the VNC clients
 do not attempt to access the surface data whilst a frame is being constructed.
-This would have undefined behaviour for Cairo, with the best result being that partial
-frames would be delivered to the client.
+A read-write lock is used, so that the clients only need to take the read lock
+and do not block one another.
+Each frame is drawn on a second surface, which the clients never see, and only
+copied to the served surface whilst the lock is held. This keeps the time that
+the clients are locked out to a single copy, however long the drawing takes.
+Without the lock, access would have undefined behaviour for Cairo, with the best
+result being that partial frames would be delivered to the client.
 """
 
 import math
@@ -25,7 +30,7 @@ class Screen(object):
     animation_period = 0.1
 
     def __init__(self):
-        self.surface_lock = threading.Lock()
+        self.surface_lock = cairovnc.ReadWriteLock()
         self.width = 200
         self.height = 200
         self.seq = 0
@@ -34,55 +39,61 @@ class Screen(object):
     def setup_surface(self):
         self.surface = cairo.ImageSurface(cairo.Format.ARGB32, self.width, self.height)
         self.context = cairo.Context(self.surface)
+        # The frame is copied from the back surface, replacing everything on the surface
+        self.context.set_operator(cairo.OPERATOR_SOURCE)
+
+        # The frames are drawn on the back surface
+        self.back_surface = cairo.ImageSurface(cairo.Format.ARGB32, self.width, self.height)
+        self.back_context = cairo.Context(self.back_surface)
         if self.surface_change_func:
             self.surface_change_func(self.surface, surface_lock=self.surface_lock)
 
     def draw(self):
-        self.context.set_source_rgb(0.5, 0.5, 0.5)
-        self.context.rectangle(0, 0, self.width, self.height)
-        self.context.fill()
+        self.back_context.set_source_rgb(0.5, 0.5, 0.5)
+        self.back_context.rectangle(0, 0, self.width, self.height)
+        self.back_context.fill()
 
-        self.context.set_source_rgb(1, 1, 1)
+        self.back_context.set_source_rgb(1, 1, 1)
 
         delta = math.cos(self.seq * math.pi / 10)
 
         x, y, x1, y1 = 0.1, 0.5, 0.4, 0.5 + delta * 0.4
         x2, y2, x3, y3 = 0.6, 0.1, 0.9, 0.5
-        self.context.save()
-        self.context.scale(self.width, self.height)
+        self.back_context.save()
+        self.back_context.scale(self.width, self.height)
 
         # Bezier curve
-        self.context.set_line_width(0.04)
-        self.context.move_to(x, y)
-        self.context.curve_to(x1, y1, x2, y2, x3, y3)
-        self.context.stroke()
+        self.back_context.set_line_width(0.04)
+        self.back_context.move_to(x, y)
+        self.back_context.curve_to(x1, y1, x2, y2, x3, y3)
+        self.back_context.stroke()
 
         # Control points
-        self.context.set_source_rgba(1, 0.2, 0.2, 0.6)
-        self.context.set_line_width(0.02)
-        self.context.move_to(x, y)
-        self.context.line_to(x1, y1)
-        self.context.move_to(x2, y2)
-        self.context.line_to(x3, y3)
-        self.context.stroke()
+        self.back_context.set_source_rgba(1, 0.2, 0.2, 0.6)
+        self.back_context.set_line_width(0.02)
+        self.back_context.move_to(x, y)
+        self.back_context.line_to(x1, y1)
+        self.back_context.move_to(x2, y2)
+        self.back_context.line_to(x3, y3)
+        self.back_context.stroke()
 
         # Red square
-        self.context.set_source_rgb(1, 0, 0)
-        self.context.rectangle(0.1, 0 + delta * 0.05, 0.1, 0.1)
-        self.context.fill()
+        self.back_context.set_source_rgb(1, 0, 0)
+        self.back_context.rectangle(0.1, 0 + delta * 0.05, 0.1, 0.1)
+        self.back_context.fill()
 
         # Green square
-        self.context.set_source_rgb(0, 1, 0)
-        self.context.rectangle(0.3, 0, 0.1, 0.1)
-        self.context.fill()
+        self.back_context.set_source_rgb(0, 1, 0)
+        self.back_context.rectangle(0.3, 0, 0.1, 0.1)
+        self.back_context.fill()
 
         # Blue square
-        self.context.set_source_rgb(0, 0, 1)
-        self.context.rectangle(0.5, 0, 0.1, 0.1)
-        self.context.fill()
-        self.context.restore()
+        self.back_context.set_source_rgb(0, 0, 1)
+        self.back_context.rectangle(0.5, 0, 0.1, 0.1)
+        self.back_context.fill()
+        self.back_context.restore()
 
-        #self.surface.write_to_png('image.png')
+        #self.back_surface.write_to_png('image.png')
 
     def animate(self):
         while True:
@@ -91,16 +102,21 @@ class Screen(object):
 
             # All accesses to the surface are protected by a lock, so that the clients see
             # them in one go.
-            with self.surface_lock:
-                # Once every 20 calls we resize the surface
-                if self.seq % 20 == 0:
+            # Once every 20 calls we resize the surface
+            if self.seq % 20 == 0:
+                with self.surface_lock.gen_wlock():
                     if int(self.seq / 20) % 2:
                         self.width = self.width + 20
                     else:
                         self.width = self.width - 20
                     self.setup_surface()
 
-                self.draw()
+            # The clients can carry on reading the surface whilst we draw the next frame
+            self.draw()
+
+            with self.surface_lock.gen_wlock():
+                self.context.set_source_surface(self.back_surface)
+                self.context.paint()
 
 
 screen = Screen()
@@ -0,0 +1,168 @@
+"""
+Tests for the FramebufferUpdate messages sent to a client.
+
+These need pycairo to be installed.
+"""
+
+import socket
+import struct
+import threading
+import unittest
+
+try:
+    import cairo
+except ImportError:
+    cairo = None
+
+if cairo:
+    import cairovnc
+    from cairovnc.constants import VNCConstants
+    from cairovnc.regions import RegionRequest
+    from cairovnc.surfacedata import SurfaceData
+
+
+class FakeServer(object):
+    """
+    Just enough of a VNCServer to supply a surface to a connection.
+    """
+    log_enabled = False
+
+    def __init__(self, surface):
+        self.options = cairovnc.CairoVNCOptions()
+        self.surface_data = SurfaceData(surface, threading.Lock())
+
+    def surface_frame(self):
+        return self.surface_data.get_frame()
+
+
+class RecordingStream(object):
+    """
+    Stream which records the data written to it.
+    """
+    closed = False
+
+    def __init__(self):
+        self.written = bytearray()
+
+    def writedata(self, data):
+        self.written += data
+
+    def writev(self, bufs):
+        for buf in bufs:
+            self.written += buf
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(cairo is None, "pycairo is not installed")
+class FramebufferUpdateTestCase(unittest.TestCase):
+    width = 40
+    height = 30
+
+    def setUp(self):
+        self.surface = cairo.ImageSurface(cairo.FORMAT_RGB24, self.width, self.height)
+        data = self.surface.get_data()
+        for offset in range(0, len(data), 4):
+            # A pattern which repeats down the rows, but not across them
+            data[offset:offset + 4] = bytes(((offset // 4) % self.width, 0x40, 0x80, 0))
+
+        self.sockets = socket.socketpair()
+        self.connection = cairovnc.VNCConnection.__new__(cairovnc.VNCConnection)
+        self.connection.request = self.sockets[0]
+        self.connection.server = FakeServer(self.surface)
+        self.connection.setup()
+        self.connection.stream.close()
+        self.connection.stream = RecordingStream()
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def request_update(self, height, encoding=None):
+        """
+        Request a non-incremental update of the whole width, and return the rectangles sent.
+
+        @param height:      Height of the region to request
+        @param encoding:    Encoding the client supports, or None for just Raw
+
+        @return: list of tuples of (x, y, width, height, encoding, payload)
+        """
+        if encoding is not None:
+            self.connection.set_capabilities([encoding])
+        self.connection.update_framebuffer(RegionRequest(False, 0, 0, self.width, height))
+        data = bytes(self.connection.stream.written)
+
+        (msgtype, _, nrects) = struct.unpack_from('>BBH', data)
+        self.assertEqual(msgtype, VNCConstants.ServerMsgType_FramebufferUpdate)
+        offset = 4
+        rects = []
+        for _ in range(nrects):
+            (x, y, width, height, encoding) = struct.unpack_from('>HHHHl', data, offset)
+            offset += 12
+            if encoding == VNCConstants.Encoding_Raw:
+                size = width * height * 4
+            else:
+                size = self.hextile_size(data, offset, width, height)
+            rects.append((x, y, width, height, encoding, data[offset:offset + size]))
+            offset += size
+
+        # Everything written must belong to the rectangles that the headers described
+        self.assertEqual(offset, len(data))
+        return rects
+
+    def hextile_size(self, data, offset, width, height):
+        """
+        Find the size of a Hextile rectangle with 4 byte pixels.
+        """
+        start = offset
+        for ty in range(0, height, 16):
+            for tx in range(0, width, 16):
+                subencoding = data[offset]
+                offset += 1
+                if subencoding & 1:
+                    offset += min(16, width - tx) * min(16, height - ty) * 4
+                elif subencoding & 2:
+                    offset += 4
+        return offset - start
+
+    def test_raw_whole_surface(self):
+        rects = self.request_update(self.height)
+        self.assertEqual([rect[:5] for rect in rects],
+                         [(0, 0, self.width, self.height, VNCConstants.Encoding_Raw)])
+        self.assertEqual(rects[0][5], bytes(self.surface.get_data()))
+
+    def test_raw_taller_than_surface(self):
+        # The rows are taken from the view of the whole frame
+        self.assertIsNotNone(self.connection.server.surface_frame()[4])
+        rects = self.request_update(self.height + 20)
+        self.assertEqual([rect[:5] for rect in rects],
+                         [(0, 0, self.width, self.height, VNCConstants.Encoding_Raw)])
+        self.assertEqual(rects[0][5], bytes(self.surface.get_data()))
+
+    def test_hextile_taller_than_surface(self):
+        rects = self.request_update(self.height + 20, encoding=VNCConstants.Encoding_Hextile)
+        self.assertEqual([rect[:5] for rect in rects],
+                         [(0, 0, self.width, self.height, VNCConstants.Encoding_Hextile)])
+
+    def test_rows_without_frame_view(self):
+        # Without the view of the whole frame, the rows are joined instead
+        server = self.connection.server
+        frame = server.surface_frame()
+        self.assertIsNotNone(frame[4])
+        server.surface_frame = lambda: frame[:4] + (None,)
+
+        rects = self.request_update(self.height + 20)
+        self.assertEqual([rect[:5] for rect in rects],
+                         [(0, 0, self.width, self.height, VNCConstants.Encoding_Raw)])
+        self.assertEqual(rects[0][5], bytes(self.surface.get_data()))
+
+    def test_request_below_surface(self):
+        self.connection.update_framebuffer(RegionRequest(False, 0, self.height + 10,
+                                                         self.width, 10))
+        self.assertEqual(bytes(self.connection.stream.written),
+                         struct.pack('>BBH', VNCConstants.ServerMsgType_FramebufferUpdate, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()